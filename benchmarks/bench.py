@@ -0,0 +1,255 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+
+__author__ = 'Fernando Serena'
+
+# Benchmarks of the store, aggregation, calculus and HTTP layers over synthetic data. Results are
+# written as JSON, so that two runs (e.g. before and after a change) can be compared with compare.py:
+#
+#   python benchmarks/bench.py --db 15 --days 730 --keys 50 --output before.json
+#   python benchmarks/compare.py before.json after.json
+#
+# The selected Redis database is flushed, so it must not be the one a metrics service uses (db 4).
+
+import argparse
+import calendar
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import date, datetime
+from threading import Event
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+DAY = 86400
+FIRST_DAY = calendar.timegm(date(2014, 1, 1).timetuple())
+BENCHMARKS = ('write', 'aggregate', 'calculus', 'http')
+
+# (name, days back from the last day or None for all the data, max)
+SHAPES = [('all-max1', None, 1), ('all-days', None, 0), ('last30-days', 30, 0), ('last90-max3', 90, 3),
+          ('last365-max12', 365, 12), ('last365-max1', 365, 1)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='SDH-Metrics benchmarks')
+    parser.add_argument('benchmarks', nargs='*', help='any of {} (all by default)'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--force', action='store_true', help='flush the database even if it is not empty')
+    parser.add_argument('--keys', type=int, default=20)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--density', type=float, default=0.8, help='fraction of days that have a value')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--max-pending', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--quads-per-day', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='file to write the results to (stdout by default)')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks).difference(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+    args.benchmarks = args.benchmarks or list(BENCHMARKS)
+    return args
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    n = len(samples)
+    if not n:
+        return {'n': 0}
+
+    def percentile(p):
+        return samples[min(n - 1, int(round(p * (n - 1))))] * 1000
+
+    return {'n': n, 'mean_ms': sum(samples) * 1000 / n, 'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95), 'max_ms': samples[-1] * 1000}
+
+
+def timed(f, *args, **kwargs):
+    start = time.time()
+    f(*args, **kwargs)
+    return time.time() - start
+
+
+def new_store(args, **kwargs):
+    from sdh.metrics.store.fragment import FragmentStore
+    return FragmentStore(args.host, max_pending=args.max_pending, port=args.port, db=args.db, **kwargs)
+
+
+def synthetic_series(args):
+    rnd = random.Random(args.seed)
+    for i in xrange(args.keys):
+        points = [(FIRST_DAY + d * DAY, rnd.randint(0, 100)) for d in xrange(args.days)
+                  if rnd.random() < args.density]
+        yield 'bench:{}'.format(i), points
+
+
+def populate(store, args):
+    from sdh.metrics.store import store_calc
+    writes = 0
+    for key, points in synthetic_series(args):
+        for timestamp, value in points:
+            store_calc(store, key, timestamp, value)
+            writes += 1
+    store.flush()
+    return writes
+
+
+def bench_write(args, results):
+    for name, options in [('sync', {}), ('async', {'asynchronous': True})]:
+        store = new_store(args, **options)
+        store.db.flushdb()
+        start = time.time()
+        writes = populate(store, args)
+        elapsed = time.time() - start
+        store.close()
+        results['write.' + name] = {'writes': writes, 'seconds': elapsed, 'writes_per_second': writes / elapsed}
+
+
+def bench_aggregate(args, results):
+    from sdh.metrics.store import aggregate, aggregate_many
+    store = new_store(args)
+    keys = ['bench:{}'.format(i) for i in xrange(args.keys)]
+    last_day = FIRST_DAY + (args.days - 1) * DAY
+    for engine in ('client', 'lua'):
+        for name, days_back, max_n in SHAPES:
+            begin = None if days_back is None else last_day - days_back * DAY
+            samples = [timed(aggregate, store, key, begin, last_day, max_n, engine=engine)
+                       for _ in xrange(args.repeat) for key in keys]
+            results['aggregate.{}.{}'.format(engine, name)] = summarize(samples)
+    for name, days_back, max_n in SHAPES:
+        begin = None if days_back is None else last_day - days_back * DAY
+        samples = [timed(aggregate_many, store, keys, begin, last_day, max_n) for _ in xrange(args.repeat)]
+        results['aggregate_many.{}'.format(name)] = summarize(samples)
+
+
+def bench_calculus(args, results):
+    from rdflib import Literal, URIRef
+    from sdh.metrics.jobs import calculus
+    from sdh.metrics.store import store_calc
+    store = new_store(args)
+    calculus.set_store(store)
+    calculus.set_executor('thread', args.workers)
+
+    def dummy_calculus(t_begin, t_end):
+        store_calc(store, 'bench:calculus', t_begin, t_end - t_begin)
+
+    calculus.add_calculus(dummy_calculus, ['bench-collector'])
+    predicate = URIRef('http://example.org/bench#date')
+    stop_event = Event()
+    quads = 0
+    start = time.time()
+    for d in xrange(args.days):
+        day = datetime.utcfromtimestamp(FIRST_DAY + d * DAY)
+        for q in xrange(args.quads_per_day):
+            subject = URIRef('http://example.org/bench/{}/{}'.format(d, q))
+            calculus.check_triggers('bench-collector', (None, subject, predicate, Literal(day)), stop_event)
+            quads += 1
+    calculus.check_triggers(None, None, stop_event)
+    store.flush()
+    elapsed = time.time() - start
+    results['calculus.triggers'] = {'quads': quads, 'days': args.days, 'seconds': elapsed,
+                                    'quads_per_second': quads / elapsed, 'days_per_second': args.days / elapsed}
+
+
+def bench_http(args, results):
+    from sdh.metrics.server import MetricsApp
+    from sdh.metrics.store import aggregate
+
+    class Config(object):
+        pass
+
+    app = MetricsApp('bench', Config)
+    app.store = new_store(args)
+
+    @app.repometric('/bench', 'sum', 'bench')
+    def get_bench(rid, **kwargs):
+        return aggregate(app.store, 'bench:' + rid, kwargs['begin'], kwargs['end'], kwargs['max'])
+
+    client = app.test_client()
+    last_day = FIRST_DAY + (args.days - 1) * DAY
+    rnd = random.Random(args.seed)
+    for accept in ('application/json', 'text/turtle'):
+        for name, days_back, max_n in SHAPES:
+            query = {'max': max_n, 'end': last_day}
+            if days_back is not None:
+                query['begin'] = last_day - days_back * DAY
+            samples = []
+            for _ in xrange(args.repeat):
+                query['rid'] = rnd.randrange(args.keys)
+                start = time.time()
+                response = client.get('/metrics/bench', query_string=query, headers={'Accept': accept},
+                                      buffered=True)
+                samples.append(time.time() - start)
+                if response.status_code != 200:
+                    raise RuntimeError('Request failed with status {}'.format(response.status_code))
+            results['http.{}.{}'.format(accept.split('/')[1], name)] = summarize(samples)
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except Exception:
+        return None
+
+
+def main():
+    args = parse_args()
+    store = new_store(args)
+    if store.db.dbsize() and not args.force:
+        sys.exit('Database {} is not empty; use --force to flush it'.format(args.db))
+    store.db.flushdb()
+
+    results = {}
+    if 'write' in args.benchmarks:
+        bench_write(args, results)
+    else:
+        populate(store, args)
+    for name in ('aggregate', 'calculus', 'http'):
+        if name in args.benchmarks:
+            globals()['bench_' + name](args, results)
+    store.db.flushdb()
+
+    report = {'meta': {'revision': revision(), 'python': platform.python_version(),
+                       'timestamp': datetime.utcnow().isoformat(),
+                       'params': dict((k, v) for k, v in vars(args).items() if k not in ('output', 'benchmarks'))},
+              'results': results}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
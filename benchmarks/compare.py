@@ -0,0 +1,62 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+
+__author__ = 'Fernando Serena'
+
+# Compare two result files of bench.py: python benchmarks/compare.py before.json after.json
+
+import json
+import sys
+
+# Figures where lower is better; for the rest (throughputs) higher is better
+LATENCIES = ('mean_ms', 'p50_ms', 'p95_ms', 'max_ms', 'seconds')
+
+
+def main(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)['results']
+    with open(after_path) as f:
+        after = json.load(f)['results']
+
+    print '{:<40} {:<18} {:>12} {:>12} {:>8}'.format('benchmark', 'figure', 'before', 'after', 'change')
+    for name in sorted(set(before).intersection(after)):
+        for figure in sorted(set(before[name]).intersection(after[name])):
+            if figure in ('n', 'writes', 'quads', 'days'):
+                continue
+            old, new = before[name][figure], after[name][figure]
+            if not old:
+                continue
+            change = (new - old) / float(old) * 100
+            better = change < 0 if figure in LATENCIES else change > 0
+            print '{:<40} {:<18} {:>12.3f} {:>12.3f} {:>+7.1f}% {}'.format(name, figure, old, new, change,
+                                                                          'better' if better else 'worse')
+    for name in sorted(set(before).symmetric_difference(after)):
+        print '{:<40} only in {}'.format(name, before_path if name in before else after_path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('usage: compare.py before.json after.json')
+    main(*sys.argv[1:])
@@ -0,0 +1,177 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+
+__author__ = 'Fernando Serena'
+
+# Recalculation of metrics over a range of days, without collecting anything nor serving requests,
+# e.g. after adding a new metric. The module that defines the metrics service is imported so that
+# its calculus and store are registered:
+#
+#   sdh-metrics-backfill myservice.app 2015-01-01 2015-12-31 -c commits_per_day --checkpoint commits.json
+
+import argparse
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from threading import Event
+
+from sdh.metrics.jobs import calculus
+from sdh.metrics import stats
+
+log = logging.getLogger('sdh.metrics')
+
+
+def parse_day(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def days_between(begin, end):
+    day = begin
+    while day <= end:
+        yield day
+        day += timedelta(days=1)
+
+
+class Checkpoint(object):
+    """Days that were already backfilled for some calculus, saved in a JSON file after every chunk"""
+
+    def __init__(self, path, names):
+        self.path = path
+        self.names = sorted(names)
+        self.done = set()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if sorted(state.get('calculus', [])) == self.names:
+                self.done = set(parse_day(day) for day in state.get('days', []))
+            else:
+                log.warning('Checkpoint {} belongs to other calculus; starting over'.format(path))
+
+    def add(self, days):
+        self.done.update(days)
+        if self.path is not None:
+            # Replaced at once, so that an interrupted backfill never leaves it half-written
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'calculus': self.names, 'days': sorted(day.isoformat() for day in self.done)}, f)
+            os.rename(tmp, self.path)
+
+
+def backfill(names, begin, end, stop_event=None, checkpoint=None, chunk=30, batch_size=None):
+    """
+    Calculate the given calculus (by name) for every day in [begin, end], most recent days first and
+    chunk days at a time in the calculus pool; batched calculus runs once per chunk. Days in the
+    checkpoint file are skipped, and the ones that fail are left for the next run. Writes reach the
+    store in batches of batch_size, if given, instead of its own. It returns a summary with the
+    throughput.
+    """
+    registered = calculus.registered_calculus()
+    unknown = [name for name in names if name not in registered]
+    if unknown:
+        raise ValueError('Unknown calculus: {}'.format(', '.join(unknown)))
+    if stop_event is None:
+        stop_event = Event()
+
+    progress = Checkpoint(checkpoint, names)
+    days = sorted([day for day in days_between(begin, end) if day not in progress.done], reverse=True)
+    skipped = (end - begin).days + 1 - len(days)
+    if skipped:
+        log.info('Resuming backfill: {} days were already calculated'.format(skipped))
+
+    store = calculus.get_store()
+    max_pending = store.max_pending if store is not None else None
+    if batch_size and store is not None:
+        store.max_pending = batch_size
+
+    start = time.time()
+    done = 0
+    try:
+        for part in calculus.chunks(days, chunk):
+            if stop_event.is_set():
+                break
+            # The store is flushed before the chunk is checkpointed
+            calculated = calculus.calculate_units([(day, names) for day in part], stop_event)
+            progress.add(calculated)
+            done += len(calculated)
+            stats.incr('backfill_days_total', len(calculated))
+            log.info('Backfilled {} of {} days ({:.2f} days/s), down to {}'.format(
+                done, len(days), done / max(time.time() - start, 1e-6), part[-1]))
+    finally:
+        if store is not None:
+            store.max_pending = max_pending
+
+    elapsed = time.time() - start
+    return {'calculus': sorted(names), 'days': done, 'failed': len(days) - done, 'skipped': skipped,
+            'seconds': elapsed, 'days_per_second': done / elapsed if elapsed else 0.0,
+            'stopped': stop_event.is_set()}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Recalculate metrics for a range of days')
+    parser.add_argument('module', help='module that defines the metrics service, e.g. myservice.app')
+    parser.add_argument('begin', type=parse_day, help='first day (YYYY-MM-DD)')
+    parser.add_argument('end', type=parse_day, help='last day (YYYY-MM-DD)')
+    parser.add_argument('-c', '--calculus', nargs='+', help='names of the calculus (all by default)')
+    parser.add_argument('--executor', choices=('thread', 'process'), default='thread')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk', type=int, default=30, help='days calculated between checkpoints')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='pending writes flushed to the store at once (the store\'s own by default)')
+    parser.add_argument('--checkpoint', help='file to save progress to and resume from')
+    args = parser.parse_args(argv)
+    if args.end < args.begin:
+        parser.error('end is before begin')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    sys.path.insert(0, os.getcwd())
+    importlib.import_module(args.module)
+    names = args.calculus or sorted(calculus.registered_calculus())
+    calculus.set_executor(args.executor, args.workers)
+
+    stop_event = Event()
+    try:
+        summary = backfill(names, args.begin, args.end, stop_event, args.checkpoint, args.chunk, args.batch_size)
+    except KeyboardInterrupt:
+        stop_event.set()
+        sys.exit('Interrupted')
+    finally:
+        store = calculus.get_store()
+        if store is not None:
+            store.close()
+    print json.dumps(summary, indent=2, sort_keys=True)
+    if summary['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -26,15 +26,24 @@ __author__ = 'Fernando Serena'
 
 import calendar
 from datetime import date
-from threading import Thread
 from datetime import datetime
 from rdflib import Literal
 import multiprocessing
+from multiprocessing.pool import ThreadPool
+from hashlib import md5
+import struct
 import logging
+from sdh.metrics import stats
 
 __calculus = set([])
+__batched = set([])
 __dates = {}
 __triggers = {}
+__fingerprints = {}
+__config = {'executor': 'thread', 'workers': None, 'store': None, 'stop': None, 'incremental': False, 'queue': None,
+            'pool': None}
+
+FINGERPRINTS_KEY = 'metrics:fingerprints'
 
 log = logging.getLogger('sdh.metrics')
 
@@ -49,8 +58,89 @@ def chunks(l, n):
             yield l[i:i + n]
 
 
-def add_calculus(func, triggers):
+def set_executor(executor='thread', n_workers=None):
+    """Choose how triggered days are calculated: a pool of threads or of (forked) processes"""
+    if executor not in ('thread', 'process'):
+        raise ValueError('Unknown calculus executor: {}'.format(executor))
+    __config['executor'] = executor
+    __config['workers'] = n_workers
+
+
+def __init_worker():
+    store = __config['store']
+    if store is not None:
+        # Locks and buffers of the parent may have been taken by its threads when it forked
+        store.after_fork()
+
+
+def start_executor():
+    """
+    Fork the worker processes of the process executor, once and for all. It should be called after all
+    calculus is registered and before the threads of the service start.
+    """
+    if __config['executor'] != 'process' or __config['pool'] is not None:
+        return
+    # Worker processes inherit this event when forked; it is set as soon as the stop event of a round is
+    __config['stop'] = multiprocessing.Event()
+    __config['pool'] = multiprocessing.Pool(__config['workers'] or workers, initializer=__init_worker)
+
+
+def stop_executor():
+    pool = __config['pool']
+    if pool is not None:
+        __config['pool'] = None
+        pool.terminate()
+        pool.join()
+
+
+def set_store(store):
+    __config['store'] = store
+
+
+def get_store():
+    return __config['store']
+
+
+def registered_calculus():
+    """Registered calculus functions by name"""
+    return dict((c.func_name, c) for c in __calculus)
+
+
+def set_incremental(incremental=True):
+    """Skip the days whose triggering quads are the same as the last time they were calculated"""
+    __config['incremental'] = incremental
+
+
+def set_queue(queue):
+    """Hand triggered days over to the workers of a calculus queue instead of calculating them here"""
+    __config['queue'] = queue
+
+
+def __quad_fingerprint(quad):
+    _, s, p, o = quad
+    digest = md5(u'{} {} {}'.format(s, p, o).encode('utf-8')).digest()
+    return struct.unpack('>Q', digest[:8])[0]
+
+
+def __fingerprint_field(d, collector):
+    return '{}|{}'.format(d.isoformat(), collector)
+
+
+def __discard_unchanged(store):
+    fields = [(d, c) for d in __dates for c in __dates[d]]
+    stored = store.db_for(FINGERPRINTS_KEY).hmget(FINGERPRINTS_KEY, [__fingerprint_field(d, c) for d, c in fields])
+    for (d, c), fp in zip(fields, stored):
+        if fp is not None and int(fp) == __fingerprints.get((d, c)):
+            __dates[d].discard(c)
+    for d in [d for d in __dates if not __dates[d]]:
+        del __dates[d]
+    stats.gauge('calculus_pending_days', len(__dates))
+
+
+def add_calculus(func, triggers, batch=False):
     __calculus.add(func)
+    if batch:
+        __batched.add(func)
     if triggers is not None:
         for trigger in triggers:
             if trigger not in __triggers.keys():
@@ -58,53 +148,302 @@ def add_calculus(func, triggers):
             __triggers[trigger].add(func)
 
 
-def start_date_calculus(stop_event):
+def __calculate_unit(unit):
+    dt, calcs, fingerprints = unit
+    stop_event = __config['stop']
+    if stop_event.is_set():
+        return dt, False
+    if __config['executor'] == 'process':
+        calcs = [c for c in __calculus if c.func_name in calcs]
+    store = __config['store']
+    succeeded = False
+    try:
+        if calcs:
+            calculate_metrics(dt, stop_event, calcs)
+        if store is not None and not stop_event.is_set():
+            for field, fp in fingerprints.items():
+                store.execute('hset', FINGERPRINTS_KEY, field, fp)
+        succeeded = not stop_event.is_set()
+    except Exception, e:
+        log.error('Calculus failed for day {}: {}'.format(dt, e))
+    if __config['executor'] == 'process' and store is not None:
+        # Pending writes of a worker process are lost unless they are flushed before it exits, and
+        # the day is not done until they are written
+        succeeded = __flush_worker(store) and succeeded
+    return dt, succeeded
+
+
+def __flush_worker(store):
+    try:
+        store.flush()
+        return True
+    except Exception, e:
+        log.error('Could not write the results of a calculus worker: {}'.format(e))
+        return False
+
+
+def __calculate_batch_unit(unit):
+    c, days = unit
+    if __config['executor'] == 'process':
+        c = [f for f in __calculus if f.func_name == c].pop()
+    stop_event = __config['stop']
+    if stop_event.is_set():
+        return c.func_name, False
+    store = __config['store']
+    succeeded = False
+    try:
+        calculate_batch(c, days)
+        succeeded = True
+    except Exception, e:
+        log.error('Batched calculus {} failed for {} days: {}'.format(c.func_name, len(days), e))
+    if __config['executor'] == 'process' and store is not None:
+        succeeded = __flush_worker(store) and succeeded
+    return c.func_name, succeeded
+
+
+def __run_units(pool, func, units, stop_event):
+    results = []
+    # Idle workers take the next unit as soon as they finish one
+    for result in pool.imap_unordered(func, units, chunksize=1):
+        results.append(result)
+        if stop_event.is_set():
+            # The remaining units return right away, and none of them is left over for the next round
+            __config['stop'].set()
+    return results
+
+
+def start_date_calculus(stop_event, final=True):
+    """
+    Calculate (or queue) the triggered days. final is False for the intermediate rounds of a
+    collection, and True once it has ended
+    """
     def get_calculus(_d):
         collectors = __dates[_d]
         return set.union(*[__triggers[c] for c in collectors])
 
-    date_chunks = chunks(list(__dates.keys()), workers)
-    for chunk in date_chunks:
-        threads = []
-        for dt in chunk:
-            thread = Thread(target=calculate_metrics,
-                            args=(dt, stop_event, get_calculus(dt)))
-            threads.append(thread)
-            thread.start()
-        [t.join() for t in threads]
+    def units(failed):
+        for dt in list(__dates.keys()):
+            calcs = get_calculus(dt)
+            # Days of a failed batch are calculated again next time, so their fingerprints are not saved
+            failed_batch = calcs & failed
+            calcs = calcs - __batched
+            if __config['executor'] == 'process':
+                calcs = [c.func_name for c in calcs]
+            fingerprints = {}
+            if __config['incremental'] and not failed_batch:
+                fingerprints = dict((__fingerprint_field(dt, c), __fingerprints[(dt, c)]) for c in __dates[dt])
+            yield dt, calcs, fingerprints
+
+    def batch_units():
+        batches = {}
+        for dt in __dates:
+            for c in get_calculus(dt) & __batched:
+                batches.setdefault(c, []).append(dt)
+        for c, days in batches.items():
+            yield c.func_name if __config['executor'] == 'process' else c, sorted(days)
+
+    store = __config['store']
+    if store is not None:
+        # Calculus must see everything the collectors have written so far
+        store.flush()
+
+    if __config['queue'] is not None:
+        __enqueue_dates(get_calculus, final)
+        return
+
+    if __config['incremental'] and store is not None:
+        __discard_unchanged(store)
+        if not __dates:
+            __fingerprints.clear()
+            return
+
+    __calculate(stop_event, batch_units(), units)
+    __dates.clear()
+    __fingerprints.clear()
+    stats.gauge('calculus_pending_days', 0)
+
+
+def __enqueue_dates(get_calculus, final):
+    queue = __config['queue']
+    store = __config['store']
+    incremental = __config['incremental'] and store is not None
+    if incremental:
+        # Fingerprints add up over the whole collection, so a day that spans several rounds is
+        # queued again unless it is back to its stored fingerprint
+        __discard_unchanged(store)
+    if __dates:
+        queue.push_many([(dt, [c.func_name for c in get_calculus(dt)]) for dt in __dates])
+        log.info('Queued {} days for calculus'.format(len(__dates)))
+    if final:
+        if incremental:
+            # Only whole days are fingerprinted; the queue is durable, so their days will be
+            # calculated even if no worker is running now
+            for (dt, c), fp in __fingerprints.items():
+                store.execute('hset', FINGERPRINTS_KEY, __fingerprint_field(dt, c), fp)
+            store.flush()
+        __fingerprints.clear()
     __dates.clear()
+    stats.gauge('calculus_pending_days', 0)
+
+
+def __calculate(stop_event, batch_units, units):
+    """Run the batch units and then the day units (given the failed batched calculus) in a pool"""
+    store = __config['store']
+    process = __config['executor'] == 'process'
+    if process:
+        # Worker processes live across rounds
+        start_executor()
+        pool = __config['pool']
+        __config['stop'].clear()
+    else:
+        __config['stop'] = stop_event
+        pool = ThreadPool(__config['workers'] or workers)
+
+    day_results = []
+    try:
+        # Batched calculus runs once over all its triggered days, before the per-day calculus
+        results = __run_units(pool, __calculate_batch_unit, batch_units, stop_event)
+        failed = set([c for c in __batched if (c.func_name, False) in results])
+        if not stop_event.is_set():
+            day_results = __run_units(pool, __calculate_unit, units(failed), stop_event)
+        if not process:
+            pool.close()
+    except Exception:
+        if process:
+            stop_executor()
+        else:
+            pool.terminate()
+        raise
+    finally:
+        if not process:
+            pool.join()
+            __config['stop'] = None
+    if store is not None:
+        store.flush()
+    return failed, day_results
+
+
+def calculate_units(units, stop_event):
+    """
+    Calculate (day, calculus names) units claimed from a calculus queue and return the days
+    whose calculus all succeeded
+    """
+    by_name = registered_calculus()
+    days = {}
+    for dt, names in units:
+        unknown = [name for name in names if name not in by_name]
+        if unknown:
+            log.warning('Unknown calculus for day {}: {}'.format(dt, unknown))
+        days.setdefault(dt, set()).update(by_name[name] for name in names if name in by_name)
+
+    def batch_units():
+        batches = {}
+        for dt, calcs in days.items():
+            for c in calcs & __batched:
+                batches.setdefault(c, []).append(dt)
+        for c, batch_days in batches.items():
+            yield c.func_name if __config['executor'] == 'process' else c, sorted(batch_days)
+
+    def day_units(failed):
+        for dt, calcs in days.items():
+            if calcs & failed:
+                continue
+            calcs = calcs - __batched
+            if __config['executor'] == 'process':
+                calcs = [c.func_name for c in calcs]
+            yield dt, calcs, {}
+
+    failed, results = __calculate(stop_event, batch_units(), day_units)
+    return set(dt for dt, succeeded in results if succeeded)
+
+
+def __add_date(d, collector, quad):
+    if d not in __dates:
+        __dates[d] = set([])
+        stats.gauge('calculus_pending_days', len(__dates))
+    __dates[d].add(collector)
+    if __config['incremental']:
+        fp = __fingerprints.get((d, collector), 0) + __quad_fingerprint(quad)
+        __fingerprints[(d, collector)] = fp & 0xFFFFFFFFFFFFFFFF
 
 
 def check_triggers(collector, quad, stop_event):
-    if collector is None and __dates:
+    if collector is None and (__dates or __fingerprints):
         start_date_calculus(stop_event)
     elif collector in __triggers:
         _, _, _, o = quad
         if isinstance(o, Literal):
             obj = o.toPython()
             if isinstance(obj, datetime):
-                d = date(obj.year, obj.month, obj.day)
-                if d not in __dates:
-                    __dates[d] = set([])
-                __dates[d].add(collector)
+                __add_date(date(obj.year, obj.month, obj.day), collector, quad)
                 if len(__dates) >= MAX_ACUM_DATES:
-                    start_date_calculus(stop_event)
+                    start_date_calculus(stop_event, final=False)
 
 
-def calculate_metrics(dt, stop_event, calcs):
+def check_triggers_batch(pairs, stop_event):
+    """
+    Same as check_triggers for every (collector, quad) pair, but each day of a collector is only
+    added once and calculus starts at most once per batch (besides the end of collection). With a
+    calculus queue, the days of every batch are queued right away
+    """
+    seen = set()
+    incremental = __config['incremental']
+    for collector, quad in pairs:
+        if collector is None:
+            if __dates or __fingerprints:
+                start_date_calculus(stop_event)
+                seen.clear()
+            continue
+        if collector not in __triggers:
+            continue
+        o = quad[3]
+        if not isinstance(o, Literal):
+            continue
+        # Literals are parsed when they are created, so this does not parse their lexical form again
+        obj = o.toPython()
+        if not isinstance(obj, datetime):
+            continue
+        d = obj.date()
+        if not incremental:
+            if (d, collector) in seen:
+                continue
+            seen.add((d, collector))
+        __add_date(d, collector, quad)
+    if __dates and (__config['queue'] is not None or len(__dates) >= MAX_ACUM_DATES):
+        start_date_calculus(stop_event, final=False)
+
+
+def day_interval(dt):
     calc_date = date(dt.year, dt.month, dt.day)
-    pre = datetime.now()
     t_begin = calendar.timegm(calc_date.timetuple())
     end_date = datetime(calc_date.year, calc_date.month, calc_date.day)
     end_date = end_date.replace(hour=23, minute=59, second=59, microsecond=999999)
     t_end = calendar.timegm(end_date.timetuple())
+    return t_begin, t_end
+
+
+def calculate_batch(c, days):
+    """Run a batched calculus once, with the sorted (begin, end) intervals of all the given days"""
+    pre = datetime.now()
+    intervals = [day_interval(dt) for dt in sorted(days)]
+    with stats.timer('calculus_batch_seconds', calculus=c.func_name):
+        c(intervals)
+    took = (datetime.now() - pre).total_seconds() * 1000
+    log.info('Updated batched calculation {} for {} days in {}ms'.format(c.func_name, len(intervals), took))
+
+
+def calculate_metrics(dt, stop_event, calcs):
+    calc_date = date(dt.year, dt.month, dt.day)
+    pre = datetime.now()
+    t_begin, t_end = day_interval(dt)
 
     # Run all triggered calculus
     for c in calcs:
-        c(t_begin, t_end)
-        if stop_event.isSet():
+        with stats.timer('calculus_seconds', calculus=c.func_name):
+            c(t_begin, t_end)
+        if stop_event.is_set():
             break
 
-    took = (datetime.now() - pre).microseconds / float(1000)
+    took = (datetime.now() - pre).total_seconds() * 1000
     calc_names = [f.func_name for f in calcs]
     log.info('Updated {} calculations ({}) for day {} in {}ms'.format(len(calc_names), calc_names, calc_date, took))
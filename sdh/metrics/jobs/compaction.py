@@ -0,0 +1,164 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+
+__author__ = 'Fernando Serena'
+
+import logging
+import time
+from threading import Thread
+from redis import WatchError
+from sdh.metrics.store.codec import encode, decode
+from sdh.metrics.store.fragment import VERSIONS_KEY
+from sdh.metrics.store.lua import rebuild_meta
+from sdh.metrics.store.partition import partition_key, index_key, resolutions_key, partition_end, INDEX_SUFFIX
+from sdh.metrics.store.series import publish_updates
+
+log = logging.getLogger('sdh.metrics')
+
+
+class RetentionPolicy(object):
+    """
+    How long the partitions of a key are kept and at which resolution. Partitions that ended more than
+    max_age seconds ago are dropped, and the ones that ended more than age seconds ago are downsampled
+    to one member per resolution seconds (aggregated with aggr), for each (age, resolution) pair.
+    Downsampled partitions no longer take writes.
+    """
+
+    def __init__(self, max_age=None, resolutions=(), aggr=sum):
+        self.max_age = max_age
+        self.resolutions = sorted(resolutions)
+        self.aggr = aggr
+
+    def resolution(self, age):
+        resolution = None
+        for min_age, res in self.resolutions:
+            if age >= min_age:
+                resolution = res
+        return resolution
+
+
+def __downsample(members, start, resolution, aggr, encoding):
+    buckets = {}
+    for member, score in members:
+        bucket = start + (int(score) - start) // resolution * resolution
+        buckets.setdefault(bucket, []).append(decode(member))
+    return [(bucket, encode(bucket, aggr(values), encoding)) for bucket, values in sorted(buckets.items())]
+
+
+def __compact_partition(store, db, key, name, start, resolution=None, aggr=None):
+    """Downsample (or drop, without resolution) a partition of key and return how many members it lost"""
+    part_key = partition_key(key, name)
+    with db.pipeline() as pipe:
+        try:
+            # Writes of the partition during its compaction make it fail, so they are never lost
+            pipe.watch(part_key)
+            members = pipe.zrange(part_key, 0, -1, withscores=True)
+            compacted = []
+            if resolution is not None:
+                downsampled = pipe.hget(resolutions_key(key), name)
+                compacted = __downsample(members, start, resolution, aggr, store.encoding)
+                if sorted(compacted) == sorted((int(s), m) for m, s in members) and downsampled == str(resolution):
+                    return 0
+            pipe.multi()
+            pipe.delete(part_key)
+            for bucket, member in compacted:
+                pipe.zadd(part_key, bucket, member)
+            if compacted:
+                # Recalculated days would otherwise be counted twice (or replace a whole bucket)
+                pipe.hset(resolutions_key(key), name, resolution)
+            else:
+                pipe.zrem(index_key(key), name)
+                pipe.hdel(resolutions_key(key), name)
+            pipe.hincrby(VERSIONS_KEY, key, 1)
+            if store.notify_updates:
+                publish_updates(pipe, [key])
+            pipe.execute()
+        except WatchError:
+            log.debug('Partition {} of {} was written while being compacted'.format(name, key))
+            return 0
+
+    if store.series is not None:
+        store.series.invalidate([key])
+
+    if store.rollups:
+        for _, score in members:
+            store.invalidate_rollups(key, int(score))
+        for bucket, _ in compacted:
+            store.invalidate_rollups(key, bucket)
+    return len(members) - len(compacted)
+
+
+def compact_key(store, key, policy, now=None):
+    """Apply a retention policy to the partitions of key and return how many members were removed"""
+    if now is None:
+        now = time.time()
+    db = store.db_for(key)
+    removed = 0
+    for name, start in db.zrange(index_key(key), 0, -1, withscores=True):
+        start = int(start)
+        age = now - partition_end(store.partition, start)
+        try:
+            if policy.max_age is not None and age >= policy.max_age:
+                removed += __compact_partition(store, db, key, name, start)
+            else:
+                resolution = policy.resolution(age)
+                if resolution is not None:
+                    removed += __compact_partition(store, db, key, name, start, resolution, policy.aggr)
+        except Exception, e:
+            log.warning('Partition {} of {} could not be compacted: {}'.format(name, key, e))
+    if removed:
+        rebuild_meta(db, key, store.partition)
+    return removed
+
+
+def compact(store, policy, match='*', now=None):
+    """Apply a retention policy to every partitioned key of the store"""
+    if not store.partition:
+        raise ValueError('Compaction requires a partitioned store')
+    removed = 0
+    for db in store.shards:
+        for index in db.scan_iter(match=index_key(match)):
+            removed += compact_key(store, index[:-len(INDEX_SUFFIX)], policy, now)
+    if store.rollups:
+        store.execute_pending()
+    log.info('Compaction removed {} members'.format(removed))
+    return removed
+
+
+def start_compaction(store, policy, stop_event, interval=3600):
+    """Compact the store every interval seconds in a daemon thread, until stop_event is set"""
+
+    def loop():
+        while not stop_event.is_set():
+            try:
+                compact(store, policy)
+            except Exception, e:
+                log.error('Compaction failed: {}'.format(e))
+            stop_event.wait(interval)
+
+    th = Thread(target=loop, name='metrics-compaction')
+    th.daemon = True
+    th.start()
+    return th
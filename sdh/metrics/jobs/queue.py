@@ -0,0 +1,289 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+
+__author__ = 'Fernando Serena'
+
+import calendar
+import json
+import logging
+import time
+import uuid
+from datetime import date, datetime
+from threading import Event, Lock, Thread
+
+from sdh.metrics.jobs.calculus import calculate_units, workers
+from sdh.metrics.store.fragment import QUEUE_PREFIX
+
+log = logging.getLogger('sdh.metrics')
+
+# Claims up to ARGV[3] of the most recent pending days of KEYS[1] that are not leased yet, after
+# returning the expired leases of KEYS[2] to it. Leases expire at ARGV[2] and are kept in the KEYS[3]
+# hash as [token, calculus names, score]; the pending calculus names of each day are in the
+# ARGV[5]<day> sets. It returns a flat list of day and JSON calculus names pairs.
+CLAIM_SCRIPT = """
+for _, day in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])) do
+    local leased = cjson.decode(redis.call('HGET', KEYS[3], day))
+    for _, name in ipairs(leased[2]) do
+        redis.call('SADD', ARGV[5] .. day, name)
+    end
+    redis.call('ZADD', KEYS[1], leased[3], day)
+    redis.call('ZREM', KEYS[2], day)
+    redis.call('HDEL', KEYS[3], day)
+end
+local n = tonumber(ARGV[3])
+local claimed = {}
+local skipped = 0
+while #claimed < 2 * n do
+    local days = redis.call('ZREVRANGE', KEYS[1], skipped, skipped + n - 1, 'WITHSCORES')
+    if #days == 0 then
+        break
+    end
+    for i = 1, #days, 2 do
+        local day = days[i]
+        if #claimed >= 2 * n then
+            break
+        elseif redis.call('HEXISTS', KEYS[3], day) == 1 then
+            -- Days being calculated stay pending until their lease ends
+            skipped = skipped + 1
+        else
+            local names = redis.call('SMEMBERS', ARGV[5] .. day)
+            redis.call('DEL', ARGV[5] .. day)
+            redis.call('ZREM', KEYS[1], day)
+            redis.call('ZADD', KEYS[2], ARGV[2], day)
+            redis.call('HSET', KEYS[3], day, cjson.encode({ARGV[4], names, tonumber(days[i + 1])}))
+            table.insert(claimed, day)
+            table.insert(claimed, cjson.encode(names))
+        end
+    end
+end
+return claimed
+"""
+
+# Ends (ARGV[3] == 'ack'), returns to KEYS[4] (ARGV[3] == 'release') or extends until ARGV[4] (ARGV[3]
+# == 'renew') the lease of day ARGV[1], if it still belongs to token ARGV[2]
+LEASE_SCRIPT = """
+local leased = redis.call('HGET', KEYS[2], ARGV[1])
+if not leased then
+    return 0
+end
+leased = cjson.decode(leased)
+if leased[1] ~= ARGV[2] then
+    return 0
+end
+if ARGV[3] == 'renew' then
+    redis.call('ZADD', KEYS[1], ARGV[4], ARGV[1])
+    return 1
+end
+if ARGV[3] == 'release' then
+    for _, name in ipairs(leased[2]) do
+        redis.call('SADD', ARGV[5] .. ARGV[1], name)
+    end
+    redis.call('ZADD', KEYS[3], leased[3], ARGV[1])
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+return 1
+"""
+
+
+def _day_score(day):
+    return calendar.timegm(day.timetuple())
+
+
+def _parse_day(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class RedisCalculusQueue(object):
+    """
+    Durable queue of the days to be calculated, shared by every worker that uses the same Redis.
+    Workers claim the most recent days first, with a lease: the days of a worker that does not
+    acknowledge them before its lease expires are claimed again by others.
+    """
+
+    def __init__(self, db, prefix=QUEUE_PREFIX):
+        self.__db = db
+        self.__pending = prefix + ':pending'
+        self.__leases = prefix + ':leases'
+        self.__leased = prefix + ':leased'
+        self.__calcs = prefix + ':calcs:'
+        self.__claim = db.register_script(CLAIM_SCRIPT)
+        self.__lease = db.register_script(LEASE_SCRIPT)
+
+    def push_many(self, units):
+        """Queue (day, calculus names) units; the names of a day that is already queued are merged"""
+        pipe = self.__db.pipeline()
+        for day, names in units:
+            if names:
+                day = date(day.year, day.month, day.day)
+                pipe.zadd(self.__pending, _day_score(day), day.isoformat())
+                pipe.sadd(self.__calcs + day.isoformat(), *names)
+        pipe.execute()
+
+    def push(self, day, names):
+        self.push_many([(day, names)])
+
+    def claim(self, n=1, lease=600):
+        """Lease up to n days and return their (day, calculus names, token) units"""
+        token = uuid.uuid4().hex
+        claimed = self.__claim(keys=[self.__pending, self.__leases, self.__leased],
+                               args=[time.time(), time.time() + lease, n, token, self.__calcs])
+        return [(_parse_day(day), json.loads(names) or [], token) for day, names in zip(claimed[::2], claimed[1::2])]
+
+    def __end(self, day, token, action, expiry=0):
+        return bool(self.__lease(keys=[self.__leases, self.__leased, self.__pending],
+                                 args=[day.isoformat(), token, action, expiry, self.__calcs]))
+
+    def ack(self, day, token):
+        """Remove a calculated day, unless its lease was lost meanwhile"""
+        return self.__end(day, token, 'ack')
+
+    def release(self, day, token):
+        """Return a leased day to the queue right away"""
+        return self.__end(day, token, 'release')
+
+    def renew(self, day, token, lease=600):
+        return self.__end(day, token, 'renew', time.time() + lease)
+
+    def __len__(self):
+        return self.__db.zcard(self.__pending)
+
+    @property
+    def leased(self):
+        return self.__db.zcard(self.__leases)
+
+
+class LocalCalculusQueue(object):
+    """In-process stand-in for RedisCalculusQueue, for a single process and its worker threads"""
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__pending = {}
+        self.__leases = {}
+
+    def __expire(self, now):
+        for day, (_, names, expiry) in self.__leases.items():
+            if expiry <= now:
+                del self.__leases[day]
+                self.__pending.setdefault(day, set()).update(names)
+
+    def push_many(self, units):
+        with self.__lock:
+            for day, names in units:
+                if names:
+                    self.__pending.setdefault(date(day.year, day.month, day.day), set()).update(names)
+
+    def push(self, day, names):
+        self.push_many([(day, names)])
+
+    def claim(self, n=1, lease=600):
+        token = uuid.uuid4().hex
+        now = time.time()
+        with self.__lock:
+            self.__expire(now)
+            days = sorted([day for day in self.__pending if day not in self.__leases], reverse=True)[:n]
+            units = []
+            for day in days:
+                names = self.__pending.pop(day)
+                self.__leases[day] = (token, names, now + lease)
+                units.append((day, sorted(names), token))
+            return units
+
+    def __owned(self, day, token):
+        lease = self.__leases.get(day)
+        return lease is not None and lease[0] == token
+
+    def ack(self, day, token):
+        with self.__lock:
+            if self.__owned(day, token):
+                del self.__leases[day]
+                return True
+            return False
+
+    def release(self, day, token):
+        with self.__lock:
+            if self.__owned(day, token):
+                _, names, _ = self.__leases.pop(day)
+                self.__pending.setdefault(day, set()).update(names)
+                return True
+            return False
+
+    def renew(self, day, token, lease=600):
+        with self.__lock:
+            if self.__owned(day, token):
+                self.__leases[day] = self.__leases[day][:2] + (time.time() + lease,)
+                return True
+            return False
+
+    def __len__(self):
+        return len(self.__pending)
+
+    @property
+    def leased(self):
+        return len(self.__leases)
+
+
+def __renew_leases(queue, units, lease, done):
+    # A third of the lease leaves time for two more attempts before it expires
+    while not done.wait(lease / 3.0):
+        for day, _, token in units:
+            try:
+                queue.renew(day, token, lease)
+            except Exception, e:
+                log.warning('Could not renew the lease of {}: {}'.format(day, e))
+
+
+def work(queue, stop_event, n=None, lease=600, wait=1.0):
+    """
+    Claim and calculate days of a calculus queue until stop_event is set. Leases are renewed while
+    their days are being calculated; days whose calculus fails are claimed again when their lease
+    expires, and the ones left when stopping are released.
+    """
+    n = n or workers
+    while not stop_event.is_set():
+        units = queue.claim(n, lease)
+        if not units:
+            stop_event.wait(wait)
+            continue
+        calculated = Event()
+        renewer = Thread(target=__renew_leases, args=(queue, units, lease, calculated))
+        renewer.daemon = True
+        renewer.start()
+        try:
+            done = calculate_units([(day, names) for day, names, _ in units], stop_event)
+        except Exception, e:
+            # e.g. their results could not be written; the days are claimed again when their leases expire
+            log.error('Could not calculate {} claimed days: {}'.format(len(units), e))
+            stop_event.wait(wait)
+            continue
+        finally:
+            calculated.set()
+            renewer.join()
+        for day, _, token in units:
+            if day in done:
+                queue.ack(day, token)
+            elif stop_event.is_set():
+                queue.release(day, token)
+        log.info('Calculated {} of {} claimed days, {} still queued'.format(len(done), len(units), len(queue)))
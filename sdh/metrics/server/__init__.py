@@ -28,12 +28,21 @@ from agora.provider.server.base import AgoraApp, get_accept
 import calendar
 from datetime import datetime
 from agora.provider.server.base import APIError, NotFound
-from flask import make_response, url_for
+from flask import make_response, url_for, request, Response, stream_with_context
+from flask import json, jsonify
 from flask_negotiate import produces
 from rdflib.namespace import Namespace, RDF
 from rdflib import Graph, URIRef, Literal
 from functools import wraps
-from sdh.metrics.jobs.calculus import check_triggers
+from threading import Thread
+from hashlib import md5
+from sdh.metrics.jobs.calculus import check_triggers_batch, set_store, set_incremental, set_queue, set_executor, \
+    start_executor, stop_executor
+from sdh.metrics.jobs.queue import RedisCalculusQueue, LocalCalculusQueue, QUEUE_PREFIX, work
+from sdh.metrics.jobs.compaction import RetentionPolicy, start_compaction
+from sdh.metrics.server.cache import MetricsCache
+from sdh.metrics.server.flight import SingleFlight
+from sdh.metrics import stats
 
 import pkg_resources
 try:
@@ -48,13 +57,15 @@ PLATFORM = Namespace('http://www.smartdeveloperhub.org/vocabulary/platform#')
 
 
 class MetricsGraph(Graph):
+    FORMATS = [('text/turtle', 'turtle'), ('text/rdf+n3', 'n3'), ('application/xml', 'xml')]
+
     def __init__(self):
         super(MetricsGraph, self).__init__()
         self.bind('metrics', METRICS)
         self.bind('platform', PLATFORM)
 
     @staticmethod
-    def __decide_serialization_format():
+    def decide_serialization_format():
         mimes = get_accept()
         if 'text/turtle' in mimes:
             return 'text/turtle', 'turtle'
@@ -65,10 +76,29 @@ class MetricsGraph(Graph):
 
     def serialize(self, destination=None, format="xml",
                   base=None, encoding=None, **args):
-        content_type, ex_format = self.__decide_serialization_format()
+        content_type, ex_format = self.decide_serialization_format()
         return content_type, super(MetricsGraph, self).serialize(destination=destination, format=ex_format,
                                                                  base=base, encoding=encoding, **args)
 
+    def serialize_all(self):
+        return dict((ex_format, (content_type, super(MetricsGraph, self).serialize(format=ex_format)))
+                    for content_type, ex_format in self.FORMATS)
+
+
+class SerializedGraph(object):
+    """
+    Wraps a graph that never changes, so that each serialization format is only computed once
+    """
+
+    def __init__(self, graph):
+        self.__graph = graph
+        self.__serializations = {}
+
+    def serialize(self, format='xml', **kwargs):
+        if format not in self.__serializations:
+            self.__serializations[format] = self.__graph.serialize(format=format, **kwargs)
+        return self.__serializations[format]
+
 
 class MetricsApp(AgoraApp):
     @staticmethod
@@ -80,10 +110,46 @@ class MetricsApp(AgoraApp):
         return g
 
     @staticmethod
-    def __return_graph(g):
-        content_type, rdf = g.serialize(format=format)
-        response = make_response(rdf)
-        response.headers['Content-Type'] = content_type
+    def __serialize_document(graph):
+        return dict((ex_format, (content_type, rdf, md5(content_type + rdf).hexdigest()))
+                    for ex_format, (content_type, rdf) in graph.serialize_all().items())
+
+    def __document(self, key, build_graph):
+        # Documents are serialized in every format once per host, and then served from memory
+        if request.url_root == self.__documents_root and key in self.__documents:
+            return self.__documents[key]
+        doc_key = ('document', key, request.url_root)
+        entry = self.__descriptions.get(doc_key)
+        if entry is not None:
+            return entry[1]
+        document = self.__serialize_document(build_graph())
+        self.__descriptions.put(doc_key, None, document)
+        return document
+
+    def __precompute_documents(self):
+        # Documents of the configured host are built before serving and kept for good
+        self.__documents = {}
+        self.__documents_root = None
+        server_name = self.config.get('SERVER_NAME')
+        if not server_name:
+            return
+        base_url = '{}://{}'.format(self.config.get('PREFERRED_URL_SCHEME') or 'http', server_name)
+        with self.test_request_context(base_url=base_url):
+            documents = {('root',): self.__serialize_document(self.__get_root_graph())}
+            for md in self.metrics.values():
+                documents[('definition', md)] = self.__serialize_document(self.__get_metric_definition_graph(md))
+            self.__documents, self.__documents_root = documents, request.url_root
+
+    def __return_document(self, key, build_graph):
+        _, ex_format = MetricsGraph.decide_serialization_format()
+        content_type, rdf, etag = self.__document(key, build_graph)[ex_format]
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+        else:
+            response = make_response(rdf)
+            response.headers['Content-Type'] = content_type
+        response.set_etag(etag)
+        response.vary.add('Accept')
         return response
 
     @produces('text/turtle', 'text/rdf+n3', 'application/rdf+xml', 'application/xml')
@@ -91,11 +157,18 @@ class MetricsApp(AgoraApp):
         if md not in self.metrics.values():
             raise NotFound('Unknown metric definition')
 
-        g = self.__get_metric_definition_graph(md)
-        return self.__return_graph(g)
+        return self.__return_document(('definition', md), lambda: self.__get_metric_definition_graph(md))
 
     @produces('text/turtle', 'text/rdf+n3', 'application/rdf+xml', 'application/xml')
     def __root(self):
+        return self.__return_document(('root',), self.__get_root_graph)
+
+    def __stats(self):
+        if request.args.get('format') == 'prometheus' or 'text/plain' in get_accept():
+            return Response(stats.prometheus(), mimetype='text/plain; version=0.0.4')
+        return jsonify(stats.snapshot())
+
+    def __get_root_graph(self):
         g = MetricsGraph()
         me = URIRef(url_for('__root', _external=True))
         g.add((me, RDF.type, METRICS.MetricService))
@@ -109,7 +182,7 @@ class MetricsApp(AgoraApp):
             g.add((md, RDF.type, METRICS.MetricDefinition))
             g.add((md, PLATFORM.identifier, Literal(mident)))
 
-        return self.__return_graph(g)
+        return g
 
     def __init__(self, name, config_class):
         super(MetricsApp, self).__init__(name, config_class)
@@ -117,17 +190,82 @@ class MetricsApp(AgoraApp):
         self.metrics = {}
         self.route('/metrics')(self.__root)
         self.route('/metrics/definitions/<md>')(self.__get_definition)
+        self.route('/metrics/_stats')(self.__stats)
         self.store = None
+        self.cache = None
+        self.flights = None
+        self.__metric_views = {}
+        # Descriptions of the service are built per host they are requested through; hosts come from
+        # the requests, so only the most recently used ones are kept
+        self.__descriptions = MetricsCache(self.config.get('DESCRIPTIONS_CACHE_SIZE', 64))
+        self.__documents = {}
+        self.__documents_root = None
+        self.before_request(self.__serve_json)
+        cache_size = self.config.get('CACHE_SIZE', 0)
+        if cache_size:
+            self.cache = MetricsCache(cache_size)
+        if self.config.get('SINGLE_FLIGHT', True):
+            self.flights = SingleFlight()
+        if self.config.get('INCREMENTAL_CALCULUS', False):
+            set_incremental()
+        # 'thread' or 'process'; worker processes are forked once, when the app starts running
+        set_executor(self.config.get('CALCULUS_EXECUTOR', 'thread'), self.config.get('CALCULUS_WORKERS'))
+        if self.config.get('STATS', False):
+            stats.enable()
+        # Collected quads are checked for calculus triggers in batches of this size
+        self.__trigger_batch = self.config.get('TRIGGER_BATCH', 1000)
+        self.__pending_quads = []
+
+    @property
+    def store(self):
+        return self.__store
+
+    @store.setter
+    def store(self, store):
+        self.__store = store
+        set_store(store)
 
     def __metric_rdfizer(self, func):
+        # The description of an endpoint only depends on the host it is requested through
+        key = ('endpoint', func, request.url_root)
+        entry = self.__descriptions.get(key)
+        if entry is not None:
+            return entry[1]
+
         g = Graph()
         g.bind('metrics', METRICS)
         g.bind('platform', PLATFORM)
         me = URIRef(url_for(func, _external=True))
         g.add((me, RDF.type, METRICS.MetricEndpoint))
         g.add((me, METRICS.supports, URIRef(url_for('__get_definition', md=self.metrics[func], _external=True))))
+        graph = SerializedGraph(g)
+        self.__descriptions.put(key, None, graph)
+        return graph
 
-        return g
+    @staticmethod
+    def __stream_json(context, data, chunk_size=1000):
+        yield '{"context":' + json.dumps(context, separators=(',', ':')) + ',"result":'
+        if isinstance(data, list):
+            yield '['
+            for i in xrange(0, len(data), chunk_size):
+                if i:
+                    yield ','
+                yield json.dumps(data[i:i + chunk_size], separators=(',', ':'))[1:-1]
+            yield ']'
+        else:
+            yield json.dumps(data, separators=(',', ':'))
+        yield '}'
+
+    def __serve_json(self):
+        view = self.__metric_views.get(request.endpoint)
+        if view is None or 'application/json' not in get_accept():
+            return None
+
+        # Same negotiation as AgoraApp, but the response is written directly and streamed
+        handler, f = view
+        args, kwargs = handler(request)
+        context, data = f(*args, **kwargs)
+        return Response(stream_with_context(self.__stream_json(context, data)), mimetype='application/json')
 
     def __add_context(self, f):
         @wraps(f)
@@ -144,18 +282,71 @@ class MetricsApp(AgoraApp):
 
         return wrapper
 
-    def metric(self, path, handler, mid):
+    def __cache_results(self, f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if self.cache is None or self.store is None:
+                return f(*args, **kwargs)
+
+            key = (f.func_name, args, tuple(sorted(kwargs.items())))
+            entry = self.cache.get(key)
+            if entry is not None:
+                versions, result = entry
+                if self.store.get_versions(versions.keys()) == versions.values():
+                    return result
+
+            # Remember the version of every key read while computing, so that later writes invalidate it
+            self.store.begin_tracking()
+            try:
+                result = f(*args, **kwargs)
+            finally:
+                versions = self.store.end_tracking()
+            if versions:
+                self.cache.put(key, versions, result)
+            else:
+                self.cache.discard(key)
+            return result
+
+        return wrapper
+
+    def __single_flight(self, f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if self.flights is None:
+                return f(*args, **kwargs)
+            # Concurrent identical requests wait for the first one and share its result
+            key = (f.func_name, args, tuple(sorted(kwargs.items())))
+            return self.flights.do(key, f, *args, **kwargs)
+
+        return wrapper
+
+    def metric(self, path, handler, mid, cache=False):
+        """
+        Register a metric endpoint. With cache, its results are kept (given CACHE_SIZE) until a key it
+        read through the store aggregations is written; f must not read the store in any other way.
+        tbd endpoints are not cached, since their end defaults to the time of each request
+        """
         def decorator(f):
+            if cache:
+                f = self.__cache_results(f)
+            f = self.__single_flight(f)
             f = self.__add_context(f)
+            self.__metric_views[f.func_name] = (handler, f)
             f = self.register('/metrics' + path, handler, self.__metric_rdfizer)(f)
             self.metrics[f.func_name] = mid
+            self.__descriptions.clear()
+            self.__documents = {}
             return f
         return decorator
 
-    def calculus(self, triggers=None):
+    def calculus(self, triggers=None, batch=False):
+        """
+        Register a calculus function. It is called as f(t_begin, t_end) once per triggered day or, if batch
+        is True, once per calculus round as f(intervals) with the sorted (t_begin, t_end) of all its days
+        """
         def decorator(f):
             from sdh.metrics.jobs.calculus import add_calculus
-            add_calculus(f, triggers)
+            add_calculus(f, triggers, batch)
             return f
         return decorator
 
@@ -209,29 +400,29 @@ class MetricsApp(AgoraApp):
 
         return context
 
-    def orgmetric(self, path, aggr, mid):
+    def orgmetric(self, path, aggr, mid, cache=False):
         def context(request):
             return [], self._get_metric_context(request)
 
-        return lambda f: self.metric(path, context, '{}-org-{}'.format(aggr, mid))(f)
+        return lambda f: self.metric(path, context, '{}-org-{}'.format(aggr, mid), cache=cache)(f)
 
-    def repometric(self, path, aggr, mid):
+    def repometric(self, path, aggr, mid, cache=False):
         def context(request):
             return [self._get_repo_context(request)], self._get_metric_context(request)
 
-        return lambda f: self.metric(path, context, '{}-repo-{}'.format(aggr, mid))(f)
+        return lambda f: self.metric(path, context, '{}-repo-{}'.format(aggr, mid), cache=cache)(f)
 
-    def usermetric(self, path, aggr, mid):
+    def usermetric(self, path, aggr, mid, cache=False):
         def context(request):
             return [self._get_user_context(request)], self._get_metric_context(request)
 
-        return lambda f: self.metric(path, context, '{}-user-{}'.format(aggr, mid))(f)
+        return lambda f: self.metric(path, context, '{}-user-{}'.format(aggr, mid), cache=cache)(f)
 
-    def repousermetric(self, path, aggr, mid):
+    def repousermetric(self, path, aggr, mid, cache=False):
         def context(request):
             return [self._get_repo_context(request), self._get_user_context(request)], self._get_metric_context(request)
 
-        return lambda f: self.metric(path, context, '{}-repo-user-{}'.format(aggr, mid))(f)
+        return lambda f: self.metric(path, context, '{}-repo-user-{}'.format(aggr, mid), cache=cache)(f)
 
     def orgtbd(self, path, mid):
         def context(request):
@@ -258,12 +449,74 @@ class MetricsApp(AgoraApp):
         return lambda f: self.metric(path, context, 'tbd-repo-user-' + mid)(f)
 
     def calculate(self, collector, quad, stop_event):
-        self.store.execute_pending()
-        check_triggers(collector, quad, stop_event)
-        self.store.execute_pending()
+        self.__pending_quads.append((collector, quad))
+        # Neither the end of collection (a None collector) nor a stop, after which no such call comes, is delayed
+        if collector is None or stop_event.is_set() or len(self.__pending_quads) >= self.__trigger_batch:
+            pairs, self.__pending_quads = self.__pending_quads, []
+            self.calculate_batch(pairs, stop_event)
+
+    def calculate_batch(self, pairs, stop_event):
+        """Check the calculus triggers of several (collector, quad) pairs at once"""
+        # An asynchronous store flushes by itself, and before every date calculus
+        if not self.store.asynchronous:
+            self.store.execute_pending()
+        check_triggers_batch(pairs, stop_event)
+        if not self.store.asynchronous:
+            self.store.execute_pending()
+
+    def __calculus_queue(self):
+        queue = self.config.get('CALCULUS_QUEUE')
+        if queue == 'redis':
+            queue = RedisCalculusQueue(self.store.db_for(QUEUE_PREFIX))
+        elif queue == 'local':
+            queue = LocalCalculusQueue()
+        return queue
+
+    def __work(self, queue):
+        work(queue, self._stop_event, self.config.get('CALCULUS_CLAIM'), self.config.get('CALCULUS_LEASE', 600))
+
+    def work(self):
+        """Calculate the days of the calculus queue of the configuration, without serving any request"""
+        queue = self.__calculus_queue()
+        if queue is None:
+            raise ValueError('No CALCULUS_QUEUE is configured')
+        start_executor()
+        if self.store is not None:
+            self.store.start()
+        try:
+            self.__work(queue)
+        except KeyboardInterrupt:
+            self._stop_event.set()
+        finally:
+            stop_executor()
+            if self.store is not None:
+                self.store.close()
 
     def run(self, host=None, port=None, debug=None, **options):
+        # Before any thread of the app is started, so that worker processes do not inherit their locks
+        start_executor()
+        if self.store is not None:
+            self.store.start()
         tasks = options.get('tasks', [])
         tasks.append(self.calculate)
         options['tasks'] = tasks
-        super(MetricsApp, self).run(host, port, debug, **options)
+        queue = self.__calculus_queue()
+        if queue is not None:
+            # Triggered days are only queued here; they are calculated by workers (see work)
+            set_queue(queue)
+            if isinstance(queue, LocalCalculusQueue):
+                th = Thread(target=self.__work, args=(queue,), name='metrics-calculus')
+                th.daemon = True
+                th.start()
+        policy = self.config.get('COMPACTION_POLICY')
+        if policy is not None and self.store is not None:
+            if isinstance(policy, dict):
+                policy = RetentionPolicy(**policy)
+            start_compaction(self.store, policy, self._stop_event, self.config.get('COMPACTION_INTERVAL', 3600))
+        self.__precompute_documents()
+        try:
+            super(MetricsApp, self).run(host, port, debug, **options)
+        finally:
+            stop_executor()
+        if self.store is not None:
+            self.store.close()
@@ -0,0 +1,187 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+__author__ = 'Fernando Serena'
+
+import time
+from threading import Lock
+
+# Counters, gauges and histograms of the hot paths (calculus, store flushes, aggregation, triggers).
+# Everything is a no-op until enable() is called, so instrumented code only pays a function call.
+# Note that the figures of forked calculus workers stay in those processes.
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+PREFIX = 'sdh_metrics_'
+
+__state = {'enabled': False}
+__lock = Lock()
+__counters = {}
+__gauges = {}
+__histograms = {}
+
+
+def enable(enabled=True):
+    __state['enabled'] = enabled
+
+
+def enabled():
+    return __state['enabled']
+
+
+def reset():
+    with __lock:
+        __counters.clear()
+        __gauges.clear()
+        __histograms.clear()
+
+
+def __series(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def incr(name, value=1, **labels):
+    if __state['enabled']:
+        series = __series(name, labels)
+        with __lock:
+            __counters[series] = __counters.get(series, 0) + value
+
+
+def gauge(name, value, **labels):
+    if __state['enabled']:
+        __gauges[__series(name, labels)] = value
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    if __state['enabled']:
+        series = __series(name, labels)
+        with __lock:
+            histogram = __histograms.get(series)
+            if histogram is None:
+                histogram = __histograms[series] = {'buckets': buckets, 'counts': [0] * len(buckets),
+                                                    'count': 0, 'sum': 0}
+            for i, le in enumerate(buckets):
+                if value <= le:
+                    histogram['counts'][i] += 1
+                    break
+            histogram['count'] += 1
+            histogram['sum'] += value
+
+
+class Timer(object):
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.time() - self.start, **self.labels)
+
+
+class __NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+__null_timer = __NullTimer()
+
+
+def timer(name, **labels):
+    """Context manager that observes the seconds spent inside it"""
+    if __state['enabled']:
+        return Timer(name, labels)
+    return __null_timer
+
+
+def __cumulative(histogram):
+    total = 0
+    for le, count in zip(histogram['buckets'], histogram['counts']):
+        total += count
+        yield le, total
+
+
+def snapshot():
+    with __lock:
+        counters, gauges = dict(__counters), dict(__gauges)
+        histograms = dict((series, dict(h, counts=list(h['counts']))) for series, h in __histograms.items())
+
+    def group(series_values, render):
+        grouped = {}
+        for (name, labels), value in sorted(series_values.items()):
+            entry = render(value)
+            entry['labels'] = dict(labels)
+            grouped.setdefault(name, []).append(entry)
+        return grouped
+
+    return {'enabled': __state['enabled'],
+            'counters': group(counters, lambda v: {'value': v}),
+            'gauges': group(gauges, lambda v: {'value': v}),
+            'histograms': group(histograms, lambda h: {'count': h['count'], 'sum': h['sum'],
+                                                       'buckets': [[le, c] for le, c in __cumulative(h)]})}
+
+
+def __labels_text(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+def prometheus():
+    """Render every series in the Prometheus text exposition format"""
+    with __lock:
+        counters, gauges = dict(__counters), dict(__gauges)
+        histograms = dict((series, dict(h, counts=list(h['counts']))) for series, h in __histograms.items())
+
+    lines = []
+    typed = set([])
+
+    def declare(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE {}{} {}'.format(PREFIX, name, kind))
+
+    for (name, labels), value in sorted(counters.items()):
+        declare(name, 'counter')
+        lines.append('{}{}{} {!r}'.format(PREFIX, name, __labels_text(labels), value))
+    for (name, labels), value in sorted(gauges.items()):
+        declare(name, 'gauge')
+        lines.append('{}{}{} {!r}'.format(PREFIX, name, __labels_text(labels), value))
+    for (name, labels), histogram in sorted(histograms.items()):
+        declare(name, 'histogram')
+        for le, count in __cumulative(histogram):
+            lines.append('{}{}_bucket{} {}'.format(PREFIX, name, __labels_text(labels, [('le', le)]), count))
+        lines.append('{}{}_bucket{} {}'.format(PREFIX, name, __labels_text(labels, [('le', '+Inf')]),
+                                               histogram['count']))
+        lines.append('{}{}_sum{} {!r}'.format(PREFIX, name, __labels_text(labels), histogram['sum']))
+        lines.append('{}{}_count{} {}'.format(PREFIX, name, __labels_text(labels), histogram['count']))
+    return '\n'.join(lines) + '\n'
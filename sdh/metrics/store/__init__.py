@@ -25,9 +25,22 @@
 __author__ = 'Fernando Serena'
 
 import calendar
+from bisect import bisect_left, bisect_right
 from datetime import date, datetime
 import types
 import math
+import time
+
+from sdh.metrics.store.codec import encode, decode, is_legacy
+from sdh.metrics.store.rollup import aggregate_steps, shortest_bucket, base_key
+from sdh.metrics.store.lua import reduce_steps, rebuild_meta
+from sdh.metrics.store.vector import reduce_days, reduce_series
+from sdh.metrics.store.partition import queue_range, read_range, join_ranges, physical_keys, partition_key, \
+    index_key, resolutions_key, downsampled_resolution, INDEX_SUFFIX
+from sdh.metrics.store.meta import queue_meta, parse_meta, meta_key
+from sdh.metrics.store.fragment import VERSIONS_KEY, QUEUE_PREFIX
+from sdh.metrics import stats
+from redis.exceptions import ResponseError
 
 import pkg_resources
 
@@ -39,25 +52,156 @@ except ImportError:
     __path__ = pkgutil.extend_path(__path__, __name__)
 
 
-def __build_time_chunk(store, key, begin, end, fill):
+def __build_time_chunk(scores, values, begin, end, fill):
     _next = begin
     while _next < end:
         _end = _next + 86400
-        stored_values = [eval(res)['v'] for res in store.db.zrangebyscore(key, _next, _end - 1)]
-        if stored_values:
-            for v in stored_values:
+        lo = bisect_left(scores, _next)
+        hi = bisect_right(scores, _end - 1, lo)
+        if lo < hi:
+            for v in values[lo:hi]:
                 yield v
         else:
             yield fill
         _next = _end
 
 
-def store_calc(store, key, timestamp, value):
-    obj_value = {'t': timestamp, 'v': value}
-    store.update_set(key, timestamp, obj_value)
+def __build_step_chunk(scores, values, begin, end):
+    lo = bisect_left(scores, begin)
+    hi = bisect_right(scores, end, lo)
+    return values[lo:hi]
+
+
+def __decode_range(members):
+    scores = []
+    values = []
+    with stats.timer('aggregate_decode_seconds'):
+        for res, score in members:
+            scores.append(score)
+            values.append(decode(res))
+    stats.incr('aggregate_members_read_total', len(members))
+    return scores, values
+
+
+def __queue_bounds(pipe, key, partition=None):
+    queue_meta(pipe, key)
+    pipe.hget(VERSIONS_KEY, key)
+    if not partition:
+        return 2
+    pipe.hgetall(resolutions_key(key))
+    return 3
+
+
+def __queue_probe(pipe, key, partition=None):
+    if partition:
+        # First and last partitions, whose first and last members need another round trip
+        pipe.zrange(index_key(key), 0, 0)
+        pipe.zrange(index_key(key), -1, -1)
+    else:
+        pipe.zrange(key, 0, 0, withscores=True, score_cast_func=int)
+        pipe.zrange(key, -1, -1, withscores=True)
+    return 2
+
+
+def __queue_partition_bounds(pipe, key, first, last):
+    pipe.zrange(partition_key(key, first), 0, 0, withscores=True, score_cast_func=int)
+    pipe.zrange(partition_key(key, last), -1, -1, withscores=True)
+    return 2
+
+
+def __key_bounds(store, keys):
+    """
+    The (data begin, data end, version, resolutions) bounds of every key, read from its metadata or, for
+    keys that have none, probing its first and last members. Resolutions are those of its downsampled
+    partitions, by name. It also returns how many round trips it took.
+    """
+    replies = __pipelined(store, keys, lambda pipe, key: __queue_bounds(pipe, key, store.partition))
+    round_trips = 1 if keys else 0
+    bounds = {}
+    resolutions = {}
+    for key, reply in replies.items():
+        meta, version = parse_meta(reply[0]), reply[1]
+        resolutions[key] = reply[2] if store.partition else {}
+        if meta is not None:
+            bounds[key] = meta['first'], meta['last'], version, resolutions[key]
+
+    legacy = [key for key in keys if key not in bounds]
+    if legacy:
+        probes = __pipelined(store, legacy, lambda pipe, key: __queue_probe(pipe, key, store.partition))
+        round_trips += 1
+        if store.partition:
+            partitioned = [key for key in legacy if probes[key][0]]
+            probes.update(__pipelined(store, partitioned, lambda pipe, key: __queue_partition_bounds(
+                pipe, key, probes[key][0][0], probes[key][1][0])))
+            round_trips += 1 if partitioned else 0
+        for key in legacy:
+            first, last = probes[key]
+            if first and last:
+                bounds[key] = first[0][1], last[0][1], replies[key][1], resolutions[key]
+            else:
+                bounds[key] = None, None, replies[key][1], resolutions[key]
+    return bounds, round_trips
+
+
+def get_meta(store, keys):
+    """Metadata (first, last, count and written) of several keys, None for the keys that have none"""
+    keys = list(keys)
+    replies = __pipelined(store, keys, queue_meta)
+    return [parse_meta(replies[key][0]) for key in keys]
+
+
+def __pipelined(store, keys, queue):
+    """
+    Queue the commands of every key in a pipeline of its shard (queue returns how many), run the
+    pipelines of all shards at once and return the replies of each key
+    """
+    shards = {}
+    for key in keys:
+        shards.setdefault(store.db_for(key), []).append(key)
+    pipes = []
+    for db, shard_keys in shards.items():
+        pipe = db.pipeline(transaction=False)
+        counts = [queue(pipe, key) for key in shard_keys]
+        pipes.append((shard_keys, counts, pipe))
+
+    replies = {}
+    for (shard_keys, counts, _), results in zip(pipes, store.execute_pipelines([pipe for _, _, pipe in pipes])):
+        for key, n in zip(shard_keys, counts):
+            replies[key] = results[:n]
+            results = results[n:]
+    return replies
+
 
+def __cached_bounds(store, key):
+    """Bounds of key from the series cache if they are fresh enough, or read (and cached) otherwise"""
+    series = store.series
+    bounds = series.bounds(key) if series is not None else None
+    if bounds is not None:
+        return bounds, 0
+    bounds, round_trips = __key_bounds(store, [key])
+    bounds = bounds[key]
+    if series is not None:
+        series.validate(key, bounds)
+    return bounds, round_trips
+
+
+def __cache_range(store, key, begin, end, members):
+    """Decode the members of a range, keeping them in the series cache if it is enabled"""
+    decoded = __decode_range(members)
+    if store.series is not None:
+        store.series.put(key, begin, end, *decoded)
+    return decoded
+
+
+def __read_bounds(plan, begin, end):
+    """Narrow a range to where the key has data, so that no more partitions than needed are read"""
+    context = plan['context']
+    return max(begin, context['data_begin']), min(end, context['data_end'])
+
+
+def __plan(begin, end, max_n, data_begin, data_end):
+    """Resolve the requested range against the data bounds and split it into steps"""
 
-def aggregate(store, key, begin, end, max_n, aggr=sum, fill=0, extend=False):
     def get_step():
         step = end - begin
         if max_n:
@@ -66,21 +210,16 @@ def aggregate(store, key, begin, end, max_n, aggr=sum, fill=0, extend=False):
         return step
 
     try:
+        if data_begin is None:
+            raise IndexError('empty key')
         if begin is None:
-            end_limit = end
-            if end is None:
-                end_limit = '+inf'
-            _, begin = store.db.zrangebyscore(key, '-inf', end_limit, withscores=True, start=0, num=1,
-                                              score_cast_func=int).pop()
-            data_begin = begin
-        else:
-            _, data_begin = store.db.zrangebyscore(key, '-inf', '+inf', withscores=True, start=0, num=1,
-                                                   score_cast_func=int).pop()
+            if end is not None and data_begin > end:
+                raise IndexError('no data before end')
+            begin = data_begin
         if end is None:
-            _, end = store.db.zrevrangebyscore(key, '+inf', begin, withscores=True, start=0, num=1).pop()
-            data_end = end
-        else:
-            _, data_end = store.db.zrevrangebyscore(key, '+inf', '-inf', withscores=True, start=0, num=1).pop()
+            if data_end < begin:
+                raise IndexError('no data after begin')
+            end = data_end
     except IndexError:
         if begin is None:
             begin = 0
@@ -89,39 +228,308 @@ def aggregate(store, key, begin, end, max_n, aggr=sum, fill=0, extend=False):
         step = get_step()
         if not max_n:
             max_n = step / 86400
-        return {'begin': begin, 'end': end, 'data_begin': None, 'data_end': None, 'step': step}, [0] * max_n
+        context = {'begin': begin, 'end': end, 'data_begin': None, 'data_end': None, 'step': step}
+        return {'context': context, 'result': [0] * max_n}
 
     begin = calendar.timegm(date.fromtimestamp(begin).timetuple())
     end = calendar.timegm(date.fromtimestamp(end).timetuple())
 
-    step_begin = begin
-    values = []
     step = get_step()
 
     extend = begin < data_begin or end > data_end or max != 1
 
+    steps = []
+    step_begin = begin
     while step_begin <= end - step:
         step_end = step_begin + step
-        if not extend:
-            chunk = [eval(res)['v'] for res in store.db.zrangebyscore(key, step_begin, step_end)]
+        steps.append((step_begin, step_end))
+        step_begin = step_end
+
+    range_end = None
+    if steps:
+        if extend:
+            last_begin, last_end = steps[-1]
+            range_end = last_begin + int(math.ceil((last_end - last_begin) / 86400.0)) * 86400 - 1
         else:
-            chunk = []
-            pre_fill = math.ceil((data_begin - begin) / 86400)
-            if pre_fill:
-                chunk += [fill] * pre_fill
-            chunk += list(__build_time_chunk(store, key, step_begin, step_end, fill))
-            post_fill = math.ceil((end - data_end) / 86400)
-            if post_fill:
-                chunk += [fill] * post_fill
+            range_end = steps[-1][1]
+
+    context = {'begin': begin, 'end': end, 'data_begin': data_begin, 'data_end': data_end,
+               'step': step if max_n else 86400}
+    return {'context': context, 'result': None, 'step': step, 'steps': steps, 'extend': extend,
+            'range_end': range_end}
+
+
+def __data_bounds(store, key, bounds):
+    begin, end, version, _ = bounds
+    store.track(key, int(version or 0))
+    return begin, end
+
+
+def __mark_resolution(store, plan, bounds):
+    # Members of downsampled partitions stand for a whole bucket and are read at its start
+    resolutions = bounds[3]
+    if resolutions and plan['result'] is None and plan['steps']:
+        read_begin, read_end = __read_bounds(plan, plan['steps'][0][0], plan['range_end'])
+        resolution = downsampled_resolution(store.partition, resolutions, read_begin, read_end)
+        if resolution is not None:
+            plan['context']['resolution'] = max(resolution, plan['context'].get('resolution'))
+
 
+def __bucket(plan, scores, stored_values, aggr, fill):
+    values = []
+    for step_begin, step_end in plan['steps']:
+        if not plan['extend']:
+            chunk = __build_step_chunk(scores, stored_values, step_begin, step_end)
+        else:
+            chunk = list(__build_time_chunk(scores, stored_values, step_begin, step_end, fill))
         values.append(chunk)
-        step_begin = step_end
+    return [aggr(part) for part in values]
+
+
+def __reduce_stats(reducer, aggr, stats):
+    s_sum, s_count, s_min, s_max = stats
+    if not s_count:
+        return aggr([])
+    if reducer == 'sum':
+        return s_sum
+    elif reducer == 'avg':
+        return s_sum / float(s_count)
+    elif reducer == 'min':
+        return s_min
+    return s_max
+
+
+def __observe_aggregate(path, start, round_trips):
+    stats.observe('aggregate_seconds', time.time() - start, path=path)
+    stats.incr('aggregate_round_trips_total', round_trips, path=path)
+
+
+def store_calc(store, key, timestamp, value):
+    store.update_set(key, timestamp, encode(timestamp, value, store.encoding))
+    if store.rollups:
+        store.invalidate_rollups(key, timestamp)
+
+
+def rebuild_rollups(store, key):
+    if store.rollups:
+        db = store.db_for(key)
+        for member_key in physical_keys(db, key, store.partition):
+            for _, timestamp in db.zrange(member_key, 0, -1, withscores=True):
+                store.invalidate_rollups(key, int(timestamp))
+        store.execute_pending()
+
+
+def migrate_key(store, key):
+    db = store.db_for(key)
+    pipe = db.pipeline()
+    migrated = 0
+    for res, score in db.zrange(key, 0, -1, withscores=True):
+        if is_legacy(res):
+            timestamp = int(score) if score.is_integer() else score
+            pipe.zrem(key, res)
+            pipe.zadd(key, score, encode(timestamp, decode(res), store.encoding))
+            migrated += 1
+    if migrated:
+        pipe.execute()
+    return migrated
+
+
+def __ensure_meta(store, db, key):
+    if not db.exists(meta_key(key)):
+        rebuild_meta(db, key, store.partition)
+
+
+def migrate(store, match='*'):
+    """Re-encode legacy members and build the metadata of the keys that still have none"""
+    migrated = 0
+    for db in store.shards:
+        for key in db.scan_iter(match=match):
+            if key.startswith(QUEUE_PREFIX + ':'):
+                continue
+            if key.endswith(INDEX_SUFFIX):
+                __ensure_meta(store, db, key[:-len(INDEX_SUFFIX)])
+            elif db.type(key) == 'zset':
+                migrated += migrate_key(store, key)
+                if not store.partition and base_key(key) == key:
+                    __ensure_meta(store, db, key)
+    return migrated
+
+
+def aggregate(store, key, begin, end, max_n, aggr=sum, fill=0, extend=False, engine=None):
+    start = time.time()
+    bounds, round_trips = __cached_bounds(store, key)
+    data_begin, data_end = __data_bounds(store, key, bounds)
+    plan = __plan(begin, end, max_n, data_begin, data_end)
+    __mark_resolution(store, plan, bounds)
+    if plan['result'] is not None:
+        __observe_aggregate('empty', start, round_trips)
+        return plan['context'], plan['result']
 
-    result = [aggr(part) for part in values]
-    if not max_n:
-        step = 86400
+    steps = plan['steps']
+    step = plan['step']
+    extend = plan['extend']
+    reducer = __reducers.get(aggr)
+    if not isinstance(fill, (int, long, float)):
+        reducer = None
+    if engine is None:
+        engine = store.engine
 
-    return {'begin': begin, 'end': end, 'data_begin': data_begin, 'data_end': data_end, 'step': step}, result
+    result = None
+    path = 'empty'
+    if not steps:
+        result = []
+    else:
+        # The whole range is read at once and bucketed locally, instead of querying per step/day
+        begin, range_end = steps[0][0], plan['range_end']
+        read_begin, read_end = __read_bounds(plan, begin, range_end)
+        members = None
+        decoded = store.series.get(key, read_begin, read_end) if store.series is not None else None
+        if decoded is not None:
+            path = 'cached'
+        elif extend and reducer and store.rollups and not step % 86400 and step >= shortest_bucket(store.rollups):
+            # Day-aligned steps that contain whole buckets are answered from the rollup tiers and the edge days
+            result = aggregate_steps(store.db_for(key), store.rollups, key, steps, reducer, fill, store.partition)
+            if result is not None:
+                path = 'rollup'
+                round_trips += 1
+        if result is None and path == 'empty' and engine == 'lua' and reducer and not store.partition:
+            round_trips += 1
+            try:
+                step_stats = reduce_steps(store.db_for(key), key, begin, step, len(steps), fill, extend, range_end)
+                result = [__reduce_stats(reducer, aggr, s) for s in step_stats]
+                path = 'lua'
+            except ResponseError:
+                # Members that cannot be reduced inside Redis (e.g. non-numeric values)
+                result = None
+
+        if result is None and engine == 'numpy' and extend and not step % 86400:
+            # Equal-size day steps are reduced over a dense day array
+            if decoded is None:
+                members = read_range(store.db_for(key), key, read_begin, read_end, store.partition)
+                round_trips += 1
+                if store.series is not None:
+                    decoded = __cache_range(store, key, read_begin, read_end, members)
+            if decoded is not None:
+                result = reduce_series(decoded[0], decoded[1], begin, len(steps), step // 86400, fill, aggr, reducer)
+            else:
+                result = reduce_days(members, begin, len(steps), step // 86400, fill, aggr, reducer)
+            if result is not None and path != 'cached':
+                path = 'numpy'
+
+        if result is None:
+            if decoded is None:
+                if members is None:
+                    members = read_range(store.db_for(key), key, read_begin, read_end, store.partition)
+                    round_trips += 1
+                decoded = __cache_range(store, key, read_begin, read_end, members)
+            scores, stored_values = decoded
+            result = __bucket(plan, scores, stored_values, aggr, fill)
+            if path != 'cached':
+                path = 'client'
+
+    __observe_aggregate(path, start, round_trips)
+    return plan['context'], result
+
+
+def aggregate_many(store, keys, begin, end, max_n, aggr=sum, fill=0, combine=None):
+    """
+    Aggregate several keys with two pipelined round trips: one for all the bounds and another one for
+    all the ranges (in parallel across shards). It returns a (context, values) pair per key or, if a
+    combine function is given, a single pair whose values are that function applied to the per-key
+    values of each step. Bounds and ranges in the series cache are not read again.
+    """
+    start = time.time()
+    keys = list(keys)
+    series = store.series
+    raw = {}
+    if series is not None:
+        for key in keys:
+            cached = series.bounds(key)
+            if cached is not None:
+                raw[key] = cached
+    stale = [key for key in keys if key not in raw]
+    read, round_trips = __key_bounds(store, stale)
+    raw.update(read)
+    if series is not None:
+        for key in stale:
+            series.validate(key, raw[key])
+    bounds = [__data_bounds(store, key, raw[key]) for key in keys]
+
+    if combine is not None:
+        # All keys share the steps of the range that covers all their data
+        begins = [b for b, _ in bounds if b is not None]
+        ends = [e for _, e in bounds if e is not None]
+        shared = __plan(begin, end, max_n, min(begins) if begins else None, max(ends) if ends else None)
+        plans = [shared] * len(keys)
+    else:
+        plans = [__plan(begin, end, max_n, b, e) for b, e in bounds]
+    for key, plan in zip(keys, plans):
+        __mark_resolution(store, plan, raw[key])
+
+    key_plans = dict(zip(keys, plans))
+    fetched = [key for key in key_plans if key_plans[key]['result'] is None and key_plans[key]['steps']]
+
+    def key_range(key):
+        plan = key_plans[key]
+        return __read_bounds(plan, plan['steps'][0][0], plan['range_end'])
+
+    def queue_key_range(pipe, key):
+        read_begin, read_end = key_range(key)
+        return queue_range(pipe, key, read_begin, read_end, store.partition)
+
+    decoded = {}
+    if series is not None:
+        for key in fetched:
+            cached = series.get(key, *key_range(key))
+            if cached is not None:
+                decoded[key] = cached
+    fetched = [key for key in fetched if key not in decoded]
+    ranges = dict((key, join_ranges(replies)) for key, replies in __pipelined(store, fetched, queue_key_range).items())
+    round_trips += 1 if fetched else 0
+    if series is not None:
+        for key, members in ranges.items():
+            read_begin, read_end = key_range(key)
+            decoded[key] = __cache_range(store, key, read_begin, read_end, members)
+
+    results = []
+    for key, plan in zip(keys, plans):
+        if plan['result'] is not None:
+            results.append((plan['context'], plan['result']))
+        else:
+            members = ranges.get(key, [])
+            values = None
+            if store.engine == 'numpy' and plan['steps'] and plan['extend'] and not plan['step'] % 86400:
+                layout = plan['steps'][0][0], len(plan['steps']), plan['step'] // 86400, fill, aggr, __reducers.get(aggr)
+                if key in decoded:
+                    values = reduce_series(decoded[key][0], decoded[key][1], *layout)
+                else:
+                    values = reduce_days(members, *layout)
+            if values is None:
+                scores, stored_values = decoded[key] if key in decoded else __decode_range(members)
+                values = __bucket(plan, scores, stored_values, aggr, fill)
+            results.append((plan['context'], values))
+    __observe_aggregate('many', start, round_trips)
+
+    if combine is None:
+        return results
+    context = plans[0]['context'] if plans else __plan(begin, end, max_n, None, None)['context']
+    return context, [combine(list(column)) for column in zip(*[values for _, values in results])]
+
+
+def percentile(q):
+    """Aggregation function for the q-th percentile (linear interpolation) of each step"""
+
+    def aggr(x):
+        x = sorted(x)
+        if not x:
+            return 0
+        k = (len(x) - 1) * q / 100.0
+        lo = int(math.floor(k))
+        hi = min(lo + 1, len(x) - 1)
+        return x[lo] + (x[hi] - x[lo]) * (k - lo)
+
+    aggr.percentile = q
+    return aggr
 
 
 def avg(x):
@@ -131,3 +539,6 @@ def avg(x):
         if x:
             return sum(x) / float(len(x))
     return 0
+
+
+__reducers = {sum: 'sum', avg: 'avg', max: 'max', min: 'min'}
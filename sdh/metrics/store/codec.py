@@ -0,0 +1,70 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+__author__ = 'Fernando Serena'
+
+import json
+import struct
+from ast import literal_eval
+
+# Member layout: one tag byte followed by the timestamp and the value
+INT_TAG = '\x01'
+FLOAT_TAG = '\x02'
+JSON_TAG = '\x03'
+
+BINARY = 'binary'
+REPR = 'repr'
+
+__int_struct = struct.Struct('>qq')
+__float_struct = struct.Struct('>qd')
+
+__int_limit = 2 ** 63
+
+
+def encode(timestamp, value, encoding=BINARY):
+    if encoding == REPR:
+        return repr({'t': timestamp, 'v': value})
+
+    if isinstance(timestamp, (int, long)) and not isinstance(value, bool):
+        if isinstance(value, (int, long)) and -__int_limit <= value < __int_limit:
+            return INT_TAG + __int_struct.pack(timestamp, value)
+        if isinstance(value, float):
+            return FLOAT_TAG + __float_struct.pack(timestamp, value)
+    return JSON_TAG + json.dumps([timestamp, value], separators=(',', ':'))
+
+
+def decode(member):
+    tag = member[:1]
+    if tag == INT_TAG:
+        return __int_struct.unpack_from(member, 1)[1]
+    if tag == FLOAT_TAG:
+        return __float_struct.unpack_from(member, 1)[1]
+    if tag == JSON_TAG:
+        return json.loads(member[1:])[1]
+    # Members written before the binary encoding existed
+    return literal_eval(member)['v']
+
+
+def is_legacy(member):
+    return member[:1] not in (INT_TAG, FLOAT_TAG, JSON_TAG)
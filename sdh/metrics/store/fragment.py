@@ -27,51 +27,450 @@ __author__ = 'Fernando Serena'
 import redis
 from agora.provider.jobs.collect import collect as acollect
 from datetime import datetime
-from threading import Lock
+from threading import Lock, Condition, Thread, local, current_thread
+import logging
+import time
+import os
+from sdh.metrics.store.codec import BINARY
+from sdh.metrics.store.rollup import dirty_buckets, update_rollups
+from sdh.metrics.store.lua import replace_member
+from sdh.metrics.store.partition import PARTITIONS
+from sdh.metrics.store.series import SeriesCache, publish_updates
+from itertools import count
+from sdh.metrics import stats
 # from redis.lock import Lock
 
+VERSIONS_KEY = 'metrics:versions'
+MAX_RETRY_DELAY = 30
+# Keys of the calculus queue, which share the store but hold no metric members
+QUEUE_PREFIX = 'metrics:calculus'
+
+log = logging.getLogger('sdh.metrics')
+
+
+class PendingBuffer(object):
+    """Actions enqueued by a single thread that are waiting to be written"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.thread = current_thread()
+        # (sequence, action name, args), so that they are written in the order they were enqueued
+        self.actions = []
+        # (key, score) -> (sequence, member); only the last write of each pair is kept
+        self.replacements = {}
+        self.dirty_rollups = set([])
+        self.oldest = None
+        self.enqueued = 0
+        self.taken = 0
+        self.written = 0
+
+    def __len__(self):
+        return len(self.actions) + len(self.replacements)
+
+    def take(self):
+        with self.lock:
+            batch = self.actions, self.replacements, self.dirty_rollups
+            self.actions = []
+            self.replacements = {}
+            self.dirty_rollups = set([])
+            self.oldest = None
+            self.taken = self.enqueued
+            return batch, self.taken
+
+    def restore(self, batch):
+        actions, replacements, dirty_rollups = batch
+        with self.lock:
+            self.actions[:0] = actions
+            merge_replacements(self.replacements, replacements)
+            self.dirty_rollups.update(dirty_rollups)
+            if self.oldest is None:
+                self.oldest = time.time()
+
+    @property
+    def idle(self):
+        return not self.thread.is_alive() and not len(self) and not self.dirty_rollups
+
+
+def merge_replacements(replacements, other):
+    for member_key, (seq, member) in other.iteritems():
+        current = replacements.get(member_key)
+        if current is None or current[0] < seq:
+            replacements[member_key] = (seq, member)
+    return replacements
+
+
 class FragmentStore(object):
-    def __init__(self, redis_host, max_pending=200):
-        self.__pool = redis.ConnectionPool(host=redis_host, port=6379, db=4)
+    def __init__(self, redis_host, max_pending=200, encoding=BINARY, rollups=None, engine='client',
+                 asynchronous=False, max_latency=1.0, max_queue=10000, retries=3, retry_delay=0.5,
+                 port=6379, db=4, partition=None, series_cache=0, series_staleness=0, notify_updates=False):
+        self.__pool = redis.ConnectionPool(host=redis_host, port=port, db=db)
         self.__r = redis.StrictRedis(connection_pool=self.__pool)
         self.__pipe = self.__r.pipeline()
         self.__pending_transactions = 0
+        # Every thread enqueues into its own buffer; this lock only guards the list of buffers
         self.__lock = Lock()
-        self.__pending_actions = []
+        # Synchronous flushes drain every buffer and write in turn, so that no older write lands last
+        self.__write_lock = Lock()
+        self.__buffers = []
+        self.__local = local()
+        self.__sequence = count()
         self.__max_pending = max_pending
+        self.encoding = encoding
+        self.rollups = tuple(rollups or ())
+        self.engine = engine
+        if partition is not None and partition not in PARTITIONS:
+            raise ValueError('Unknown partition: {}'.format(partition))
+        # Members of every key are split into one sorted set per year or month
+        self.partition = partition
+        self.__tracking = local()
+        # Decoded members of up to series_cache members are kept in memory between reads
+        self.__series = SeriesCache(series_cache, series_staleness) if series_cache else None
+        # Written keys are published, so that the series caches of other processes forget them
+        self.notify_updates = notify_updates
+
+        self.__asynchronous = asynchronous
+        self.__max_latency = max_latency
+        self.__max_queue = max(max_queue, max_pending)
+        self.__retries = retries
+        self.__retry_delay = retry_delay
+        # A batch the writer could not write is kept, and retried with a backoff up to MAX_RETRY_DELAY
+        self.__failed = None
+        self.__retry_at = None
+        self.__backoff = retry_delay
+        self.__error = None
+        self.__cond = Condition(self.__lock)
+        self.__flush_requested = False
+        self.__full = False
+        self.__closing = False
+        self.__pid = os.getpid()
+        self.__writer = None
+        if asynchronous:
+            self.__writer = Thread(target=self.__write_loop, name='FragmentStore writer')
+            self.__writer.daemon = True
+            self.__writer.start()
 
-    def __pipeline_actions(self):
-        r = redis.StrictRedis(connection_pool=self.__pool)
-        pipe = r.pipeline()
-        [pipe.__getattribute__(action_name)(*args) for (action_name, args) in self.__pending_actions]
+    def __buffer(self):
+        buf = getattr(self.__local, 'buffer', None)
+        if buf is None:
+            buf = self.__local.buffer = PendingBuffer()
+            with self.__lock:
+                self.__buffers.append(buf)
+        return buf
+
+    def __drain(self):
+        """Take the pending actions of all threads, merged into a single batch"""
+        with self.__lock:
+            buffers = list(self.__buffers)
+        actions, replacements, dirty_rollups, marks = [], {}, set([]), []
+        if self.__failed is not None:
+            # Older than anything in the buffers
+            actions, replacements, dirty_rollups = self.__failed
+            self.__failed = None
+        for buf in buffers:
+            (buf_actions, buf_replacements, buf_dirty), taken = buf.take()
+            actions.extend(buf_actions)
+            merge_replacements(replacements, buf_replacements)
+            dirty_rollups.update(buf_dirty)
+            marks.append((buf, taken))
+        with self.__lock:
+            # Buffers of finished threads are forgotten once they are empty
+            self.__buffers = [buf for buf in self.__buffers if not buf.idle]
+        return (actions, replacements, dirty_rollups), marks
+
+    @staticmethod
+    def __action_key(args):
+        # Fields of the versions hash are keys themselves, and live with them
+        if len(args) > 1 and args[0] == VERSIONS_KEY:
+            return args[1]
+        return args[0]
+
+    def __write(self, batch):
+        actions, replacements, dirty_rollups = batch
+        start = time.time()
+        try:
+            # One pipeline per shard that is written to
+            pipes = {}
+
+            def pipe_for(key):
+                db = self.db_for(key)
+                if db not in pipes:
+                    pipes[db] = db.pipeline()
+                return pipes[db]
+
+            # Replacements and raw actions are interleaved in the order they were enqueued
+            ops = [(seq, None, key_ts, member) for key_ts, (seq, member) in replacements.iteritems()]
+            ops.extend((seq, action_name, args, None) for seq, action_name, args in actions)
+            ops.sort(key=lambda op: op[0])
+            for _, action_name, args, member in ops:
+                if action_name is None:
+                    key, timestamp = args
+                    replace_member(pipe_for(key), key, timestamp, member, VERSIONS_KEY, self.partition)
+                else:
+                    pipe_for(self.__action_key(args)).__getattribute__(action_name)(*args)
+            written = [key for key, _ in replacements] + [self.__action_key(args) for _, _, args in actions]
+            if self.notify_updates:
+                for db, pipe in pipes.items():
+                    publish_updates(pipe, [key for key in written if self.db_for(key) is db])
+            self.execute_pipelines(pipes.values())
+            if self.__series is not None:
+                self.__series.invalidate(written)
+            shard_rollups = {}
+            for bucket in dirty_rollups:
+                shard_rollups.setdefault(self.db_for(bucket[0]), []).append(bucket)
+            for db, buckets in shard_rollups.items():
+                update_rollups(db, buckets, VERSIONS_KEY, self.partition)
+        except Exception:
+            stats.incr('store_flush_failures_total')
+            raise
+        stats.observe('store_flush_seconds', time.time() - start)
+        stats.observe('store_flush_size', self.__batch_size(batch), buckets=stats.SIZE_BUCKETS)
+
+    def __pipeline_actions(self, buf, batch):
         try:
-            pipe.execute()
-            self.__pending_actions = []
+            self.__write(batch)
         except Exception, e:
-            print e.message
+            # Kept pending, so that they are retried on the next flush
+            buf.restore(batch)
+            log.error('Could not write {} pending actions: {}'.format(self.__batch_size(batch), e))
+            return e
+
+    @staticmethod
+    def __batch_size(batch):
+        actions, replacements, _ = batch
+        return len(actions) + len(replacements)
+
+    @staticmethod
+    def __is_empty(batch):
+        return not any(batch)
+
+    def __write_with_retries(self, batch):
+        """Write a batch, retrying a few times; it returns the last error if it could not"""
+        delay = self.__retry_delay
+        size = self.__batch_size(batch)
+        for attempt in xrange(self.__retries + 1):
+            try:
+                self.__write(batch)
+                return None
+            except Exception, e:
+                log.warning('Could not write {} pending actions (attempt {}): {}'.format(size, attempt + 1, e))
+                if attempt < self.__retries:
+                    time.sleep(delay)
+                    delay *= 2
+        return e
+
+    def __backlog(self):
+        return self.__batch_size(self.__failed) if self.__failed is not None else 0
+
+    def __oldest_pending(self):
+        oldest = [buf.oldest for buf in self.__buffers if buf.oldest is not None]
+        return min(oldest) if oldest else None
+
+    def __wait_batch(self):
+        """Wait until a buffer is full, the oldest pending action is too old or a flush is requested"""
+        while not (self.__full or self.__flush_requested or self.__closing):
+            if self.__failed is not None:
+                remaining = self.__retry_at - time.time()
+                if remaining <= 0:
+                    break
+                self.__cond.wait(remaining)
+                continue
+            oldest = self.__oldest_pending()
+            if oldest is None:
+                self.__cond.wait(self.__max_latency)
+                continue
+            remaining = oldest + self.__max_latency - time.time()
+            if remaining <= 0:
+                break
+            self.__cond.wait(remaining)
+        self.__full = self.__flush_requested = False
+        return self.__closing
+
+    def __write_loop(self):
+        while True:
+            with self.__cond:
+                closing = self.__wait_batch()
+            batch, marks = self.__drain()
+            empty = self.__is_empty(batch)
+            error = None
+            if not empty:
+                error = self.__write_with_retries(batch)
+            with self.__cond:
+                if error is None:
+                    self.__backoff = self.__retry_delay
+                    for buf, taken in marks:
+                        buf.written = max(buf.written, taken)
+                elif closing:
+                    # Nothing is dropped silently: close() raises it
+                    self.__error = error
+                    log.error('Dropped {} pending actions when closing: {}'.format(self.__batch_size(batch), error))
+                else:
+                    # Kept pending (flush() callers keep waiting for it) and retried later
+                    self.__failed = batch
+                    self.__retry_at = time.time() + self.__backoff
+                    self.__backoff = min(self.__backoff * 2, MAX_RETRY_DELAY)
+                    log.error('Could not write {} pending actions; retrying in {}s: {}'.format(
+                        self.__batch_size(batch), self.__retry_at - time.time(), error))
+                # Producers blocked on a full buffer and flush() callers can go on
+                self.__cond.notify_all()
+            if closing and (empty or error is not None):
+                return
+
+    @property
+    def asynchronous(self):
+        # Forked worker processes do not inherit the writer thread, so they write synchronously
+        return self.__writer is not None and self.__pid == os.getpid()
+
+    def __enqueue(self, action=None, replacement=None):
+        buf = self.__buffer()
+        with buf.lock:
+            if buf.oldest is None:
+                buf.oldest = time.time()
+            if action is not None:
+                buf.actions.append((next(self.__sequence),) + action)
+            else:
+                member_key, member = replacement
+                buf.replacements[member_key] = (next(self.__sequence), member)
+            buf.enqueued += 1
+            enqueued = buf.enqueued
+            pending = len(buf)
+
+        if pending < self.__max_pending:
+            return
+        if self.asynchronous:
+            with self.__cond:
+                self.__full = True
+                self.__cond.notify_all()
+                # Backpressure: wait for the writer when this thread's buffer is too long, or while
+                # too many writes it could not write are waiting to be retried
+                while not self.__closing and ((pending >= self.__max_queue and buf.taken < enqueued) or
+                                              self.__backlog() >= self.__max_queue):
+                    self.__cond.wait()
+        else:
+            self.__flush_all()
+
+    def __flush_all(self):
+        # Older writes of the same member may be pending in the buffers of other threads, so they are
+        # all merged; and batches are written one at a time, in the order they were drained
+        with self.__write_lock:
+            batch, _ = self.__drain()
+            if not self.__is_empty(batch):
+                return self.__pipeline_actions(self.__buffer(), batch)
+
+    def after_fork(self):
+        """Start afresh in a forked process, whose copies of the locks may be held by threads it has not"""
+        self.__lock = Lock()
+        self.__write_lock = Lock()
+        self.__cond = Condition(self.__lock)
+        self.__buffers = []
+        self.__local = local()
+        self.__flush_requested = self.__full = self.__closing = False
+        self.__failed = self.__error = None
+        if self.__series is not None:
+            self.__series = SeriesCache(self.__series.max_members, self.__series.max_staleness)
 
     def execute(self, action_name, *args):
-        self.__lock.acquire()
-        self.__pending_actions.append((action_name, args))
-        if len(self.__pending_actions) >= self.__max_pending:
-            self.__pipeline_actions()
-        self.__lock.release()
+        """Enqueue a raw Redis command, which is written in order with the other pending writes"""
+        self.__enqueue(action=(action_name, args))
 
     def execute_pending(self):
-        self.__lock.acquire()
-        if self.__pending_actions:
-            self.__pipeline_actions()
-        self.__lock.release()
+        if self.asynchronous:
+            # Asks the writer to flush now, without waiting for it
+            with self.__cond:
+                self.__flush_requested = True
+                self.__cond.notify_all()
+        else:
+            self.__flush_all()
+
+    def flush(self):
+        """
+        Write everything that is pending and wait until it is done. Writes that fail are kept pending:
+        a synchronous store raises their error, and an asynchronous one waits until they are retried
+        """
+        if not self.asynchronous:
+            error = self.__flush_all()
+            if error is not None:
+                raise error
+            return
+        with self.__cond:
+            targets = [(buf, buf.enqueued) for buf in self.__buffers]
+            self.__flush_requested = True
+            self.__cond.notify_all()
+            while any(buf.written < target for buf, target in targets) and self.__writer.is_alive():
+                self.__cond.wait(self.__max_latency)
+
+    def close(self):
+        """Drain the pending actions and stop the writer, raising the error of any that were lost"""
+        if not self.asynchronous:
+            return self.flush()
+        with self.__cond:
+            self.__closing = True
+            self.__cond.notify_all()
+        self.__writer.join()
+        if self.__error is not None:
+            raise self.__error
+
+    def invalidate_rollups(self, key, timestamp):
+        buf = self.__buffer()
+        with buf.lock:
+            if buf.oldest is None:
+                buf.oldest = time.time()
+            buf.dirty_rollups.update(dirty_buckets(self.rollups, key, timestamp))
 
     def update_set(self, key, timestamp, value):
-        self.execute('zremrangebyscore', key, timestamp, timestamp)
-        self.execute('zadd', key, timestamp, value)
+        # Writes of the same key and timestamp that are still pending collapse into the last one
+        self.__enqueue(replacement=((key, timestamp), value))
+
+    def get_versions(self, keys):
+        if not keys:
+            return []
+        keys = list(keys)
+        shards = {}
+        for i, key in enumerate(keys):
+            shards.setdefault(self.db_for(key), []).append(i)
+        versions = [0] * len(keys)
+        for db, indexes in shards.items():
+            for i, v in zip(indexes, db.hmget(VERSIONS_KEY, [keys[i] for i in indexes])):
+                versions[i] = int(v or 0)
+        return versions
+
+    def begin_tracking(self):
+        self.__tracking.keys = {}
+
+    def end_tracking(self):
+        keys = getattr(self.__tracking, 'keys', None)
+        self.__tracking.keys = None
+        return keys or {}
+
+    def track(self, key, version):
+        keys = getattr(self.__tracking, 'keys', None)
+        if keys is not None:
+            keys.setdefault(key, version)
 
     def collect(self, tp):
         def wrapper(f):
             return acollect(tp, self)(f)
         return wrapper
 
+    def start(self):
+        """Listen to the keys that other processes write, so that the series cache forgets them at once"""
+        if self.__series is not None and self.notify_updates:
+            self.__series.subscribe(self.shards)
+
+    @property
+    def max_pending(self):
+        """Pending writes of a thread that trigger a flush"""
+        return self.__max_pending
+
+    @max_pending.setter
+    def max_pending(self, max_pending):
+        self.__max_pending = max_pending
+        self.__max_queue = max(self.__max_queue, max_pending)
+
+    @property
+    def series(self):
+        """The cache of decoded members, if enabled"""
+        return self.__series
+
     @property
     def first_date(self):
         import calendar
@@ -79,4 +478,17 @@ class FragmentStore(object):
 
     @property
     def db(self):
+        # Reads through the client are not tracked, so whatever is being tracked cannot be cached
+        self.__tracking.keys = None
+        return self.__r
+
+    def db_for(self, key):
+        """The Redis client that holds key"""
         return self.__r
+
+    @property
+    def shards(self):
+        return [self.__r]
+
+    def execute_pipelines(self, pipes):
+        return [pipe.execute() for pipe in pipes]
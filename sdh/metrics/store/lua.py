@@ -0,0 +1,246 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+__author__ = 'Fernando Serena'
+
+import time
+
+from sdh.metrics.store.partition import partition_of, partition_key, index_key, resolutions_key, PART_MARKER
+from sdh.metrics.store.meta import meta_key
+
+# Per-step sum, count, min and max of the members of a key, decoded and reduced inside Redis.
+# Each step yields five values: sum, count, min, max and a flags string telling which of
+# (sum, min, max) are floats, so that the Python side can restore the original types.
+AGGREGATE_SCRIPT = """
+local begin = tonumber(ARGV[1])
+local step = tonumber(ARGV[2])
+local n = tonumber(ARGV[3])
+local fill = tonumber(ARGV[4])
+local fill_float = ARGV[5] == '1'
+local extend = ARGV[6] == '1'
+local range_end = tonumber(ARGV[7])
+
+local raw = redis.call('ZRANGEBYSCORE', KEYS[1], begin, range_end, 'WITHSCORES')
+local scores, values, floats = {}, {}, {}
+for i = 1, #raw, 2 do
+    local member = raw[i]
+    local tag = string.byte(member, 1)
+    local v, is_float
+    if tag == 1 then
+        local _, x = struct.unpack('>i8i8', member, 2)
+        v, is_float = x, false
+    elseif tag == 2 then
+        local _, x = struct.unpack('>i8d', member, 2)
+        v, is_float = x, true
+    elseif tag == 3 then
+        v = cjson.decode(string.sub(member, 2))[2]
+        is_float = type(v) == 'number' and v ~= math.floor(v)
+    else
+        local text = string.match(member, "'v':%s*([^,}]+)")
+        v = tonumber(text)
+        is_float = text ~= nil and string.find(text, '[.eE]') ~= nil
+    end
+    if type(v) ~= 'number' then
+        return redis.error_reply('non-numeric member')
+    end
+    local k = #scores + 1
+    scores[k] = tonumber(raw[i + 1])
+    values[k] = v
+    floats[k] = is_float
+end
+
+local function lower_bound(x)
+    local lo, hi = 1, #scores + 1
+    while lo < hi do
+        local mid = math.floor((lo + hi) / 2)
+        if scores[mid] < x then lo = mid + 1 else hi = mid end
+    end
+    return lo
+end
+
+local function fmt(x)
+    if x == nil then return '' end
+    return string.format('%.17g', x)
+end
+
+local result = {}
+for s = 0, n - 1 do
+    local s_begin = begin + s * step
+    local s_end = s_begin + step
+    local sum, count, lo_v, hi_v = 0, 0, nil, nil
+    local sum_float, lo_float, hi_float = false, false, false
+    local function add(v, f)
+        sum = sum + v
+        count = count + 1
+        if f then sum_float = true end
+        if lo_v == nil or v < lo_v then lo_v, lo_float = v, f end
+        if hi_v == nil or v > hi_v then hi_v, hi_float = v, f end
+    end
+    if extend then
+        local d = s_begin
+        while d < s_end do
+            local i = lower_bound(d)
+            local found = false
+            while i <= #scores and scores[i] <= d + 86399 do
+                add(values[i], floats[i])
+                found = true
+                i = i + 1
+            end
+            if not found then add(fill, fill_float) end
+            d = d + 86400
+        end
+    else
+        local i = lower_bound(s_begin)
+        while i <= #scores and scores[i] <= s_end do
+            add(values[i], floats[i])
+            i = i + 1
+        end
+    end
+    local flags = (sum_float and '1' or '0') .. (lo_float and '1' or '0') .. (hi_float and '1' or '0')
+    table.insert(result, fmt(sum))
+    table.insert(result, tostring(count))
+    table.insert(result, fmt(lo_v))
+    table.insert(result, fmt(hi_v))
+    table.insert(result, flags)
+end
+return result
+"""
+
+# Atomically replaces the member of KEYS[1] at score ARGV[1] with ARGV[2] and bumps the ARGV[3] version
+# in the KEYS[2] hash. The KEYS[3] metadata of the key is updated (written at ARGV[4]) if it has any,
+# or created if the key is new. For partitioned keys, KEYS[4] is the partition index, where the ARGV[6]
+# partition is added with the ARGV[5] score, and KEYS[5] the resolutions of the downsampled partitions,
+# which are never written to (it returns 0 then).
+REPLACE_SCRIPT = """
+if KEYS[5] and redis.call('HEXISTS', KEYS[5], ARGV[6]) == 1 then
+    return 0
+end
+local fresh = redis.call('EXISTS', KEYS[4] or KEYS[1]) == 0
+local replaced = redis.call('ZREMRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[1])
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+redis.call('HINCRBY', KEYS[2], ARGV[3], 1)
+if KEYS[4] then
+    redis.call('ZADD', KEYS[4], ARGV[5], ARGV[6])
+end
+local meta = redis.call('HMGET', KEYS[3], 'first', 'last', 'count')
+if meta[3] or fresh then
+    local score = tonumber(ARGV[1])
+    if not meta[1] or score < tonumber(meta[1]) then
+        redis.call('HSET', KEYS[3], 'first', ARGV[1])
+    end
+    if not meta[2] or score > tonumber(meta[2]) then
+        redis.call('HSET', KEYS[3], 'last', ARGV[1])
+    end
+    if replaced == 0 then
+        redis.call('HINCRBY', KEYS[3], 'count', 1)
+    end
+    redis.call('HSET', KEYS[3], 'written', ARGV[4])
+end
+return 1
+"""
+
+# Recomputes the KEYS[1] metadata of key ARGV[1] from its members, in the sorted sets ARGV[1]ARGV[2]<name>
+# for every partition name in the KEYS[2] index if it is partitioned. ARGV[3] is the last write time.
+META_SCRIPT = """
+local sets = {ARGV[1]}
+if KEYS[2] then
+    sets = {}
+    for _, name in ipairs(redis.call('ZRANGE', KEYS[2], 0, -1)) do
+        table.insert(sets, ARGV[1] .. ARGV[2] .. name)
+    end
+end
+local first, last, count = nil, nil, 0
+for _, set in ipairs(sets) do
+    local n = redis.call('ZCARD', set)
+    if n > 0 then
+        count = count + n
+        local lo = redis.call('ZRANGE', set, 0, 0, 'WITHSCORES')[2]
+        local hi = redis.call('ZRANGE', set, -1, -1, 'WITHSCORES')[2]
+        if not first or tonumber(lo) < tonumber(first) then
+            first = lo
+        end
+        if not last or tonumber(hi) > tonumber(last) then
+            last = hi
+        end
+    end
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], 'count', count)
+redis.call('HSET', KEYS[1], 'written', ARGV[3])
+if first then
+    redis.call('HSET', KEYS[1], 'first', first)
+    redis.call('HSET', KEYS[1], 'last', last)
+end
+return count
+"""
+
+__scripts = {}
+
+
+def __script(db, name, source):
+    script = __scripts.get(name)
+    if script is None:
+        script = __scripts[name] = db.register_script(source)
+    return script
+
+
+def __number(text, is_float):
+    if is_float:
+        return float(text)
+    return int(float(text))
+
+
+def reduce_steps(db, key, begin, step, n, fill, extend, range_end):
+    """Return the (sum, count, min, max) of each step, or None for min/max of empty steps"""
+    script = __script(db, 'aggregate', AGGREGATE_SCRIPT)
+    args = [begin, step, n, repr(fill), int(isinstance(fill, float)), int(bool(extend)), range_end]
+    raw = script(keys=[key], args=args, client=db)
+
+    steps = []
+    for i in xrange(0, len(raw), 5):
+        s_sum, s_count, s_min, s_max, flags = raw[i:i + 5]
+        steps.append((__number(s_sum, flags[0] == '1'), int(s_count),
+                      __number(s_min, flags[1] == '1') if s_min else None,
+                      __number(s_max, flags[2] == '1') if s_max else None))
+    return steps
+
+
+def replace_member(pipe, key, timestamp, value, versions_key, partition=None, written=None):
+    """Queue the replacement of the member of key at timestamp in the given pipeline"""
+    script = __script(pipe, 'replace', REPLACE_SCRIPT)
+    if written is None:
+        written = time.time()
+    if not partition:
+        script(keys=[key, versions_key, meta_key(key)], args=[timestamp, value, key, written], client=pipe)
+    else:
+        name, start = partition_of(partition, timestamp)
+        script(keys=[partition_key(key, name), versions_key, meta_key(key), index_key(key), resolutions_key(key)],
+               args=[timestamp, value, key, written, start, name], client=pipe)
+
+
+def rebuild_meta(db, key, partition=None, written=None):
+    """Recompute the metadata of key from its members and return how many it has"""
+    script = __script(db, 'meta', META_SCRIPT)
+    keys = [meta_key(key)] + ([index_key(key)] if partition else [])
+    return script(keys=keys, args=[key, PART_MARKER, written or time.time()], client=db)
@@ -0,0 +1,52 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+
+__author__ = 'Fernando Serena'
+
+# Every key written since metadata exists has a '<key>:meta' hash with the scores of its first and
+# last members, how many members it has and when it was last written. Keys without it (written
+# before) are probed instead, until their metadata is rebuilt (see migrate).
+META_SUFFIX = ':meta'
+META_FIELDS = ('first', 'last', 'count', 'written')
+
+
+def meta_key(key):
+    return key + META_SUFFIX
+
+
+def queue_meta(pipe, key):
+    pipe.hmget(meta_key(key), *META_FIELDS)
+    return 1
+
+
+def parse_meta(reply):
+    """The metadata of a key as a dict, or None if it has none"""
+    first, last, count, written = reply
+    if count is None:
+        return None
+    return {'first': int(float(first)) if first is not None else None,
+            'last': float(last) if last is not None else None,
+            'count': int(count),
+            'written': float(written) if written is not None else None}
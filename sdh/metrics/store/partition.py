@@ -0,0 +1,136 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+
+__author__ = 'Fernando Serena'
+
+import calendar
+from datetime import datetime
+
+# Partitioned keys keep their members in one sorted set per period ('<key>:part:<period>'), and the
+# periods that exist in an index sorted set ('<key>:partitions') scored by their start timestamp.
+# Periods downsampled by compaction are read-only, and their resolution (in seconds) is kept in the
+# '<key>:resolutions' hash.
+PARTITIONS = ('year', 'month')
+PART_MARKER = ':part:'
+INDEX_SUFFIX = ':partitions'
+RESOLUTIONS_SUFFIX = ':resolutions'
+
+
+def partition_key(key, name):
+    return '{}{}{}'.format(key, PART_MARKER, name)
+
+
+def index_key(key):
+    return key + INDEX_SUFFIX
+
+
+def resolutions_key(key):
+    return key + RESOLUTIONS_SUFFIX
+
+
+def partition_start(partition, ts):
+    dt = datetime.utcfromtimestamp(ts)
+    if partition == 'year':
+        dt = datetime(dt.year, 1, 1)
+    elif partition == 'month':
+        dt = datetime(dt.year, dt.month, 1)
+    else:
+        raise ValueError('Unknown partition: {}'.format(partition))
+    return calendar.timegm(dt.timetuple())
+
+
+def partition_end(partition, start):
+    dt = datetime.utcfromtimestamp(start)
+    if partition == 'year':
+        dt = datetime(dt.year + 1, 1, 1)
+    elif dt.month == 12:
+        dt = datetime(dt.year + 1, 1, 1)
+    else:
+        dt = datetime(dt.year, dt.month + 1, 1)
+    return calendar.timegm(dt.timetuple())
+
+
+def partition_name(partition, start):
+    dt = datetime.utcfromtimestamp(start)
+    if partition == 'year':
+        return '{:04d}'.format(dt.year)
+    return '{:04d}-{:02d}'.format(dt.year, dt.month)
+
+
+def partition_of(partition, ts):
+    """The (name, start) of the partition that holds ts"""
+    start = partition_start(partition, ts)
+    return partition_name(partition, start), start
+
+
+def partitions_between(partition, begin, end):
+    start = partition_start(partition, begin)
+    while start <= end:
+        yield partition_name(partition, start), start
+        start = partition_end(partition, start)
+
+
+def downsampled_resolution(partition, resolutions, begin, end):
+    """The coarsest resolution of the downsampled partitions that overlap [begin, end], or None"""
+    found = [int(resolutions[name]) for name, _ in partitions_between(partition, begin, end) if name in resolutions]
+    return max(found) if found else None
+
+
+def queue_range(pipe, key, begin, end, partition=None):
+    """Queue the reads of the members of key in [begin, end], one per partition it spans, and return how many"""
+    if not partition:
+        pipe.zrangebyscore(key, begin, end, withscores=True)
+        return 1
+    n = 0
+    for name, _ in partitions_between(partition, begin, end):
+        pipe.zrangebyscore(partition_key(key, name), begin, end, withscores=True)
+        n += 1
+    return n
+
+
+def join_ranges(ranges):
+    return [member for members in ranges for member in members]
+
+
+def split_ranges(results, counts):
+    """Join the results of each group of reads queued by queue_range, given how many each one queued"""
+    ranges = []
+    for n in counts:
+        ranges.append(join_ranges(results[:n]))
+        results = results[n:]
+    return ranges
+
+
+def read_range(db, key, begin, end, partition=None):
+    pipe = db.pipeline(transaction=False)
+    queue_range(pipe, key, begin, end, partition)
+    return join_ranges(pipe.execute())
+
+
+def physical_keys(db, key, partition=None):
+    """The sorted sets that hold the members of key"""
+    if not partition:
+        return [key]
+    return [partition_key(key, name) for name in db.zrange(index_key(key), 0, -1)]
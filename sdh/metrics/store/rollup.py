@@ -0,0 +1,216 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+__author__ = 'Fernando Serena'
+
+import calendar
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+from sdh.metrics.store.codec import encode, decode
+from sdh.metrics.store.partition import queue_range, split_ranges, join_ranges, PART_MARKER, INDEX_SUFFIX, \
+    RESOLUTIONS_SUFFIX
+from sdh.metrics.store.meta import META_SUFFIX
+
+DAY = 86400
+TIERS = ('week', 'month', 'year')
+# Days of the shortest bucket of each tier
+SHORTEST = {'week': 7, 'month': 28, 'year': 365}
+
+
+def rollup_key(key, tier):
+    return '{}:rollup:{}'.format(key, tier)
+
+
+def base_key(key):
+    """The key a derived (rollup, partition, partition index, resolutions or metadata) key belongs to"""
+    for marker in (':rollup:', PART_MARKER):
+        if marker in key:
+            return key[:key.rindex(marker)]
+    for suffix in (INDEX_SUFFIX, RESOLUTIONS_SUFFIX, META_SUFFIX):
+        if key.endswith(suffix):
+            return key[:-len(suffix)]
+    return key
+
+
+def bucket_start(tier, ts):
+    dt = datetime.utcfromtimestamp(ts)
+    if tier == 'week':
+        dt -= timedelta(days=dt.weekday())
+        dt = datetime(dt.year, dt.month, dt.day)
+    elif tier == 'month':
+        dt = datetime(dt.year, dt.month, 1)
+    elif tier == 'year':
+        dt = datetime(dt.year, 1, 1)
+    else:
+        raise ValueError('Unknown rollup tier: {}'.format(tier))
+    return calendar.timegm(dt.timetuple())
+
+
+def bucket_end(tier, start):
+    dt = datetime.utcfromtimestamp(start)
+    if tier == 'week':
+        return start + 7 * DAY
+    elif tier == 'month':
+        if dt.month == 12:
+            dt = datetime(dt.year + 1, 1, 1)
+        else:
+            dt = datetime(dt.year, dt.month + 1, 1)
+    else:
+        dt = datetime(dt.year + 1, 1, 1)
+    return calendar.timegm(dt.timetuple())
+
+
+def dirty_buckets(tiers, key, timestamp):
+    return [(key, tier, bucket_start(tier, timestamp)) for tier in tiers]
+
+
+def __partial(scores, values):
+    if not values:
+        return None
+    days = len(set(int(score) // DAY for score in scores))
+    return [sum(values), len(values), days, min(values), max(values)]
+
+
+def __read_ranges(db, ranges, partition):
+    """Read several (key, begin, end) ranges with a single pipeline"""
+    pipe = db.pipeline(transaction=False)
+    counts = [queue_range(pipe, key, begin, end, partition) for key, begin, end in ranges]
+    return split_ranges(pipe.execute(), counts)
+
+
+def update_rollups(db, buckets, versions_key=None, partition=None):
+    """Recompute the partial aggregates (sum, count, days, min, max) of the given dirty buckets"""
+    buckets = list(buckets)
+    if not buckets:
+        return
+    ranges = __read_ranges(db, [(key, start, bucket_end(tier, start) - 1) for key, tier, start in buckets],
+                           partition)
+
+    pipe = db.pipeline(transaction=False)
+    for (key, tier, start), members in zip(buckets, ranges):
+        r_key = rollup_key(key, tier)
+        partial = __partial([score for _, score in members], [decode(res) for res, _ in members])
+        pipe.zremrangebyscore(r_key, start, start)
+        if partial is not None:
+            pipe.zadd(r_key, start, encode(start, partial))
+    if versions_key is not None:
+        # Readers must not keep results computed from the rollups that were just replaced
+        for key in set(key for key, _, _ in buckets):
+            pipe.hincrby(versions_key, key, 1)
+    pipe.execute()
+
+
+def __decompose(tiers, begin, end):
+    """Split [begin, end) into the coarsest whole tier buckets it contains, plus the remaining edge days"""
+    parts = []
+    cursor = begin
+    while cursor < end:
+        for tier in tiers:
+            if bucket_start(tier, cursor) == cursor:
+                b_end = bucket_end(tier, cursor)
+                if b_end <= end:
+                    parts.append((tier, cursor, b_end))
+                    cursor = b_end
+                    break
+        else:
+            if parts and parts[-1][0] is None:
+                parts[-1] = (None, parts[-1][1], cursor + DAY)
+            else:
+                parts.append((None, cursor, cursor + DAY))
+            cursor += DAY
+    return parts
+
+
+def __reduce(reducer, partials, days, fill):
+    total, count, days_with_data = 0, 0, 0
+    lo = hi = None
+    for p_sum, p_count, p_days, p_min, p_max in partials:
+        total += p_sum
+        count += p_count
+        days_with_data += p_days
+        lo = p_min if lo is None else min(lo, p_min)
+        hi = p_max if hi is None else max(hi, p_max)
+    missing = days - days_with_data
+    if missing:
+        total += fill * missing
+        count += missing
+        lo = fill if lo is None else min(lo, fill)
+        hi = fill if hi is None else max(hi, fill)
+    if reducer == 'sum':
+        return total
+    elif reducer == 'avg':
+        return total / float(count) if count else 0
+    elif reducer == 'min':
+        return lo
+    return hi
+
+
+def shortest_bucket(tiers):
+    """Length in seconds of the shortest bucket of the given tiers; shorter steps never contain one"""
+    return min(SHORTEST[tier] for tier in tiers) * DAY
+
+
+def aggregate_steps(db, tiers, key, steps, reducer, fill, partition=None):
+    """
+    Reduce day-aligned steps reading whole tier buckets from the rollups and the edge days from the key,
+    all in one round trip. It returns None if no step contains a whole bucket, so nothing would be saved.
+    """
+    tiers = sorted(tiers, key=TIERS.index, reverse=True)
+    decomposed = [__decompose(tiers, s_begin, s_end) for s_begin, s_end in steps]
+    if not any(tier is not None for parts in decomposed for tier, _, _ in parts):
+        return None
+    begin, end = steps[0][0], steps[-1][1]
+    edges = [(p_begin, p_end) for parts in decomposed for (tier, p_begin, p_end) in parts if tier is None]
+
+    pipe = db.pipeline(transaction=False)
+    for tier in tiers:
+        pipe.zrangebyscore(rollup_key(key, tier), begin, end - 1, withscores=True)
+    if edges:
+        # A single range over all the edges, bucketed here
+        queue_range(pipe, key, edges[0][0], edges[-1][1] - 1, partition)
+    results = pipe.execute()
+
+    tier_partials = {}
+    for tier, members in zip(tiers, results):
+        tier_partials[tier] = dict((int(score), decode(res)) for res, score in members)
+    members = sorted(join_ranges(results[len(tiers):]), key=lambda member: member[1])
+    scores = [score for _, score in members]
+    edge_partials = {}
+    for p_begin, p_end in edges:
+        lo, hi = bisect_left(scores, p_begin), bisect_left(scores, p_end)
+        edge_partials[(p_begin, p_end)] = __partial(scores[lo:hi], [decode(res) for res, _ in members[lo:hi]])
+
+    values = []
+    for (s_begin, s_end), parts in zip(steps, decomposed):
+        partials = []
+        for tier, p_begin, p_end in parts:
+            if tier is None:
+                partial = edge_partials[(p_begin, p_end)]
+            else:
+                partial = tier_partials[tier].get(p_begin)
+            if partial is not None:
+                partials.append(partial)
+        values.append(__reduce(reducer, partials, (s_end - s_begin) // DAY, fill))
+    return values
@@ -0,0 +1,172 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+
+__author__ = 'Fernando Serena'
+
+import json
+import logging
+import os
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from threading import Lock, Thread
+
+from sdh.metrics.store.rollup import base_key
+from sdh.metrics import stats
+
+# Writers can publish the keys they change here, so that the caches of other processes forget them
+UPDATES_CHANNEL = 'metrics:updates'
+
+log = logging.getLogger('sdh.metrics')
+
+
+def publish_updates(pipe, keys):
+    keys = sorted(set(base_key(key) for key in keys))
+    if keys:
+        pipe.publish(UPDATES_CHANNEL, json.dumps(keys))
+
+
+class _Entry(object):
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.checked = time.time()
+        self.begin = self.end = None
+        self.scores = self.values = ()
+
+
+class SeriesCache(object):
+    """
+    LRU cache of the decoded members of keys, bounded by the number of members it holds. Every entry
+    keeps the bounds and version of its key and one contiguous segment of its members. Bounds are
+    served without asking Redis for max_staleness seconds after they were last read, and segments
+    only while the version of their key stays the same.
+    """
+
+    def __init__(self, max_members=100000, max_staleness=0):
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+        self.__members = 0
+        self.max_members = max_members
+        self.__subscribed = None
+        self.max_staleness = max_staleness
+
+    def __drop(self, key):
+        entry = self.__entries.pop(key, None)
+        if entry is not None:
+            self.__members -= len(entry.scores)
+
+    def bounds(self, key):
+        """The cached (first, last, version, resolutions) bounds of key, or None if they have to be read again"""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or time.time() - entry.checked > self.max_staleness:
+                return None
+            return entry.bounds
+
+    def validate(self, key, bounds):
+        """Keep the bounds just read for key, forgetting its segment if its version changed"""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry.bounds[2] != bounds[2]:
+                self.__drop(key)
+                entry = None
+            if entry is None:
+                entry = self.__entries[key] = _Entry(bounds)
+            entry.bounds = bounds
+            entry.checked = time.time()
+
+    def get(self, key, begin, end):
+        """The decoded (scores, values) of key in [begin, end], or None if they are not cached"""
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is not None:
+                self.__entries[key] = entry
+            if entry is None or entry.begin is None or begin < entry.begin or end > entry.end:
+                stats.incr('series_cache_misses_total')
+                return None
+            lo, hi = bisect_left(entry.scores, begin), bisect_right(entry.scores, end)
+            stats.incr('series_cache_hits_total')
+            return entry.scores[lo:hi], entry.values[lo:hi]
+
+    def put(self, key, begin, end, scores, values):
+        """Cache the decoded members of key in [begin, end], merging them with an overlapping segment"""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                # Only keys whose version is known can be validated later
+                return
+            scores, values = list(scores), list(values)
+            if entry.begin is not None and begin <= entry.end and entry.begin <= end:
+                lo, hi = bisect_left(entry.scores, begin), bisect_right(entry.scores, end)
+                scores = entry.scores[:lo] + scores + entry.scores[hi:]
+                values = entry.values[:lo] + values + entry.values[hi:]
+                begin, end = min(begin, entry.begin), max(end, entry.end)
+            self.__members += len(scores) - len(entry.scores)
+            entry.begin, entry.end, entry.scores, entry.values = begin, end, scores, values
+            while self.__members > self.max_members and self.__entries:
+                self.__drop(next(iter(self.__entries)))
+
+    def invalidate(self, keys):
+        with self.__lock:
+            for key in keys:
+                self.__drop(base_key(key))
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__members = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @property
+    def members(self):
+        return self.__members
+
+    def subscribe(self, shards):
+        """Forget the keys that writers publish as updated in any of the shards, from now on"""
+        with self.__lock:
+            # Listeners do not survive a fork
+            if self.__subscribed == os.getpid():
+                return
+            self.__subscribed = os.getpid()
+        for db in shards:
+            pubsub = db.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(UPDATES_CHANNEL)
+            th = Thread(target=self.__listen, args=(pubsub,), name='SeriesCache listener')
+            th.daemon = True
+            th.start()
+
+    def __listen(self, pubsub):
+        while True:
+            try:
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.invalidate(json.loads(message['data']))
+            except Exception, e:
+                # Whatever was published meanwhile is lost, so nothing cached can be trusted
+                log.warning('Lost the subscription to {}: {}'.format(UPDATES_CHANNEL, e))
+                self.clear()
+                time.sleep(1)
@@ -0,0 +1,157 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+
+__author__ = 'Fernando Serena'
+
+import os
+import struct
+from bisect import bisect
+from hashlib import md5
+from multiprocessing.pool import ThreadPool
+
+import redis
+
+from sdh.metrics.store.fragment import FragmentStore, VERSIONS_KEY, QUEUE_PREFIX, log
+from sdh.metrics.store.rollup import base_key
+
+
+def parse_node(node, port=6379, db=4):
+    """A node is a (host, port, db) tuple or a 'host[:port][/db]' string"""
+    if isinstance(node, (tuple, list)):
+        return tuple(node) + (port, db)[len(node) - 1:]
+    if '/' in node:
+        node, db = node.split('/', 1)
+    if ':' in node:
+        node, port = node.split(':', 1)
+    return node, int(port), int(db)
+
+
+class HashRing(object):
+    """Consistent hashing of keys onto nodes, with a number of points per node to even the load"""
+
+    def __init__(self, nodes, replicas=160):
+        points = sorted((self.__hash('{}#{}'.format(node, i)), node) for node in nodes for i in xrange(replicas))
+        self.__hashes = [h for h, _ in points]
+        self.__nodes = [node for _, node in points]
+
+    @staticmethod
+    def __hash(value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return struct.unpack('>Q', md5(value).digest()[:8])[0]
+
+    def get(self, key):
+        return self.__nodes[bisect(self.__hashes, self.__hash(key)) % len(self.__hashes)]
+
+
+class ShardedFragmentStore(FragmentStore):
+    """
+    A FragmentStore whose keys are partitioned across several Redis nodes. Rollup keys and the
+    version of each key live in the node of the key they belong to. Unlike FragmentStore, it has no
+    db: code that reads the client directly must use db_for(key) instead.
+    """
+
+    def __init__(self, nodes, replicas=160, **kwargs):
+        nodes = [parse_node(node) for node in nodes]
+        if not nodes:
+            raise ValueError('At least one node is required')
+        host, port, db = nodes[0]
+        super(ShardedFragmentStore, self).__init__(host, port=port, db=db, **kwargs)
+        self.__clients = {}
+        for host, port, db in nodes:
+            name = '{}:{}/{}'.format(host, port, db)
+            self.__clients[name] = redis.StrictRedis(connection_pool=redis.ConnectionPool(host=host, port=port, db=db))
+        self.__names = sorted(self.__clients)
+        self.__ring = HashRing(self.__names, replicas)
+        self.__pool = None
+        self.__pool_pid = None
+
+    @property
+    def db(self):
+        # Not an AttributeError, which hasattr and __getattr__ would silently take as a missing attribute
+        raise TypeError('A sharded store has no single db; use db_for(key), or shards for all of its nodes')
+
+    def db_for(self, key):
+        return self.__clients[self.__ring.get(base_key(key))]
+
+    @property
+    def shards(self):
+        return [self.__clients[name] for name in self.__names]
+
+    def execute_pipelines(self, pipes):
+        pipes = list(pipes)
+        if len(pipes) < 2:
+            return [pipe.execute() for pipe in pipes]
+        if self.__pool is None or self.__pool_pid != os.getpid():
+            self.__pool = ThreadPool(len(self.__clients))
+            self.__pool_pid = os.getpid()
+        return self.__pool.map(lambda pipe: pipe.execute(), pipes)
+
+    def close(self):
+        try:
+            super(ShardedFragmentStore, self).close()
+        finally:
+            if self.__pool is not None and self.__pool_pid == os.getpid():
+                self.__pool.close()
+                self.__pool = None
+
+
+def __owner(store, key):
+    # All the keys of the calculus queue live in the shard of its prefix
+    if key.startswith(QUEUE_PREFIX + ':'):
+        key = QUEUE_PREFIX
+    return store.db_for(key)
+
+
+def rebalance(store, match='*'):
+    """
+    Move every key that is not in the shard the ring of the store assigns it to (e.g. after adding a
+    node) along with its version. It is meant to run while nothing writes to the store.
+    """
+    moved = 0
+    for db in store.shards:
+        # Listed before anything is moved, so that the scan does not run over a changing keyspace
+        misplaced = [key for key in db.scan_iter(match=match) if key != VERSIONS_KEY and __owner(store, key) is not db]
+        for key in misplaced:
+            owner = __owner(store, key)
+            dump = db.dump(key)
+            if dump is None:
+                continue
+            version = db.hget(VERSIONS_KEY, key)
+            pipe = owner.pipeline()
+            pipe.delete(key)
+            pipe.restore(key, 0, dump)
+            if version is not None:
+                # A new version, so that cached results of the key are validated against the new node
+                pipe.hset(VERSIONS_KEY, key, int(version) + 1)
+            pipe.execute()
+            pipe = db.pipeline()
+            pipe.delete(key)
+            pipe.hdel(VERSIONS_KEY, key)
+            pipe.execute()
+            moved += 1
+    if moved:
+        log.info('Moved {} keys to their shards'.format(moved))
+    return moved
@@ -0,0 +1,155 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+
+__author__ = 'Fernando Serena'
+
+from sdh.metrics.store.codec import decode, INT_TAG, FLOAT_TAG
+from sdh.metrics import stats
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DAY = 86400
+BINARY_SIZE = 17
+
+__layouts = {INT_TAG: ('>i8', int), FLOAT_TAG: ('>f8', float)}
+
+
+def __decode_values(raw):
+    """Values of the members and their types; binary members of a single type are decoded at once"""
+    tag = raw[0][:1] if raw else None
+    if tag in __layouts and all(len(res) == BINARY_SIZE and res[:1] == tag for res in raw):
+        value_type, kind = __layouts[tag]
+        layout = np.dtype([('tag', 'S1'), ('t', '>i8'), ('v', value_type)])
+        values = np.frombuffer(''.join(raw), dtype=layout)['v']
+        return values, set([kind])
+    values = [decode(res) for res in raw]
+    return values, set(type(v) for v in values)
+
+
+def __int_bound(values, fill, n_days):
+    """Largest magnitude that the sum of n_days of values (or fill) may reach"""
+    ints = [abs(v) for v in values if isinstance(v, (int, long))] if isinstance(values, list) else \
+        [abs(int(values.min())), abs(int(values.max()))] if len(values) else []
+    return max(ints + [abs(fill)]) * n_days
+
+
+def __dense_days(scores, values, kinds, begin, n_days, fill):
+    """
+    Day-indexed values of a range, with fill for missing days, and which of those days hold int
+    values when ints and floats are mixed (None otherwise). It returns None if a day has several members.
+    """
+    days = ((scores - begin) // DAY).astype(np.int64)
+    if len(days) > 1 and not np.all(np.diff(days) > 0):
+        return None
+
+    kinds.add(type(fill))
+    ints = None
+    # numpy wraps around out of the int64 range, and floats lose exactness for ints past 2 ** 53
+    if kinds <= set([int, long]) and __int_bound(values, fill, n_days) < 2 ** 63:
+        dense = np.full(n_days, fill, dtype=np.int64)
+    elif kinds == set([float]) or (kinds <= set([int, long, float]) and __int_bound(values, fill, n_days) < 2 ** 53):
+        dense = np.full(n_days, fill, dtype=np.float64)
+        if kinds != set([float]):
+            ints = np.full(n_days, isinstance(fill, (int, long)), dtype=bool)
+            ints[days] = [isinstance(v, (int, long)) for v in values]
+    else:
+        # Non-numeric or too large values are kept as Python objects, so that aggr sees the same values
+        dense = [fill] * n_days
+        if not isinstance(values, list):
+            values = values.tolist()
+        for day, value in zip(days.tolist(), values):
+            dense[day] = value
+        return dense, None
+    dense[days] = values
+    return dense, ints
+
+
+def __typed(values, ints):
+    """Values back with the int type of the Python values they stand for"""
+    return [int(v) if is_int else v for v, is_int in zip(values, ints)]
+
+
+def reduce_days(members, begin, n_steps, days_per_step, fill, aggr, reducer=None):
+    """
+    Reduce the members of a range into n_steps steps of days_per_step days each, every missing day
+    counting as fill. It returns None when the members cannot be laid out one per day.
+    """
+    if np is None:
+        return None
+    scores = np.fromiter((score for _, score in members), dtype=np.float64, count=len(members))
+    with stats.timer('aggregate_decode_seconds'):
+        values, kinds = __decode_values([res for res, _ in members])
+    stats.incr('aggregate_members_read_total', len(members))
+    return __reduce_dense(scores, values, kinds, begin, n_steps, days_per_step, fill, aggr, reducer)
+
+
+def reduce_series(scores, values, begin, n_steps, days_per_step, fill, aggr, reducer=None):
+    """Same as reduce_days, for members that are already decoded"""
+    if np is None:
+        return None
+    return __reduce_dense(np.array(scores, dtype=np.float64), values, set(type(v) for v in values), begin,
+                          n_steps, days_per_step, fill, aggr, reducer)
+
+
+def __reduce_dense(scores, values, kinds, begin, n_steps, days_per_step, fill, aggr, reducer):
+    laid_out = __dense_days(scores, values, kinds, begin, n_steps * days_per_step, fill)
+    if laid_out is None:
+        return None
+    dense, ints = laid_out
+    if isinstance(dense, list):
+        return [aggr(dense[i:i + days_per_step]) for i in xrange(0, len(dense), days_per_step)]
+
+    steps = dense.reshape(n_steps, days_per_step)
+    if ints is not None:
+        ints = ints.reshape(n_steps, days_per_step)
+    percentile = getattr(aggr, 'percentile', None)
+    if reducer in ('sum', 'avg'):
+        # Accumulated in order, as the built-in sum does, so float results are the same
+        sums = np.cumsum(steps, axis=1)[:, -1]
+        if reducer == 'avg':
+            return (sums / float(days_per_step)).tolist()
+        if ints is not None:
+            return __typed(sums.tolist(), ints.all(axis=1).tolist())
+        return sums.tolist()
+    elif reducer in ('min', 'max'):
+        # The first extreme day of each step, as the built-in min and max return
+        picked = (steps.argmin if reducer == 'min' else steps.argmax)(axis=1)
+        rows = np.arange(n_steps)
+        if ints is not None:
+            return __typed(steps[rows, picked].tolist(), ints[rows, picked].tolist())
+        return steps[rows, picked].tolist()
+    elif percentile is not None:
+        # Same interpolation as percentile() in the store, which np.percentile may round differently
+        ordered = np.sort(steps, axis=1)
+        k = (days_per_step - 1) * percentile / 100.0
+        lo = int(k)
+        hi = min(lo + 1, days_per_step - 1)
+        return (ordered[:, lo] + (ordered[:, hi] - ordered[:, lo]) * (k - lo)).tolist()
+    if ints is not None:
+        return [aggr(__typed(step, step_ints)) for step, step_ints in zip(steps.tolist(), ints.tolist())]
+    return [aggr(step) for step in steps.tolist()]
@@ -39,5 +39,7 @@ setup(
     packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
     namespace_packages=['sdh', 'sdh.metrics', 'sdh.metrics.store', 'sdh.metrics.jobs'],
     install_requires=['flask', 'Flask_Negotiate', 'redis', 'hiredis', 'rdflib', 'Agora-Service-Provider', 'pytz'],
+    extras_require={'numpy': ['numpy']},
+    entry_points={'console_scripts': ['sdh-metrics-backfill = sdh.metrics.jobs.backfill:main']},
     classifiers=[]
 )
@@ -0,0 +1,65 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+__author__ = 'Fernando Serena'
+
+
+import unittest
+
+from sdh.metrics.store.codec import encode, decode, is_legacy, BINARY, REPR, INT_TAG, FLOAT_TAG, JSON_TAG
+
+
+class CodecTest(unittest.TestCase):
+    def test_round_trip(self):
+        for value in [0, -7, 2 ** 62, -2 ** 63, 1.5, -0.25, 2 ** 70, True, None, 'text', [1, 2.5], {'a': 1}]:
+            member = encode(1420070400, value, BINARY)
+            self.assertFalse(is_legacy(member))
+            self.assertEqual(decode(member), value)
+            # Ints and floats are told apart, as aggregations return them as they are
+            self.assertEqual(isinstance(decode(member), float), isinstance(value, float))
+
+    def test_tags(self):
+        self.assertEqual(encode(0, 1)[:1], INT_TAG)
+        self.assertEqual(encode(0, 1.0)[:1], FLOAT_TAG)
+        # Out of the int64 range, booleans and non-integer timestamps are kept as JSON
+        self.assertEqual(encode(0, 2 ** 63)[:1], JSON_TAG)
+        self.assertEqual(encode(0, False)[:1], JSON_TAG)
+        self.assertEqual(encode(0.5, 1)[:1], JSON_TAG)
+
+    def test_members_are_unique_per_timestamp(self):
+        self.assertNotEqual(encode(0, 1), encode(86400, 1))
+        self.assertEqual(len(encode(0, 1)), len(encode(86400, 2)))
+
+    def test_legacy(self):
+        # Members written before the binary encoding existed
+        for value in [3, 2.5, [1, 2], {'a': 'b'}]:
+            member = repr({'t': 1420070400, 'v': value})
+            self.assertTrue(is_legacy(member))
+            self.assertEqual(decode(member), value)
+        self.assertEqual(encode(1420070400, 3, REPR), repr({'t': 1420070400, 'v': 3}))
+        self.assertTrue(is_legacy(encode(1420070400, 3, REPR)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+__author__ = 'Fernando Serena'
+
+
+import unittest
+from threading import Thread
+
+from sdh.metrics.store import fragment
+from sdh.metrics.store.fragment import FragmentStore, merge_replacements
+
+
+class FakePipeline(object):
+    """Records the commands of a pipeline, which are written when it is executed"""
+
+    def __init__(self, db):
+        self.db = db
+        self.commands = []
+
+    def delete(self, *args):
+        self.commands.append(('delete',) + args)
+
+    def hset(self, *args):
+        self.commands.append(('hset',) + args)
+
+    def execute(self):
+        if self.db.failures:
+            self.db.failures -= 1
+            raise IOError('Connection lost')
+        self.db.written.extend(self.commands)
+        return [True] * len(self.commands)
+
+
+class FakeDb(object):
+    def __init__(self):
+        self.written = []
+        self.failures = 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakeStore(FragmentStore):
+    def __init__(self, **kwargs):
+        super(FakeStore, self).__init__('localhost', **kwargs)
+        self.fake = FakeDb()
+
+    def db_for(self, key):
+        return self.fake
+
+
+def fake_replace(pipe, key, timestamp, member, versions_key, partition=None, written=None):
+    pipe.commands.append(('replace', key, timestamp, member))
+
+
+class MergeReplacementsTest(unittest.TestCase):
+    def test_newest_wins(self):
+        replacements = {('k', 1): (5, 'a'), ('k', 2): (1, 'b')}
+        merged = merge_replacements(replacements, {('k', 1): (3, 'old'), ('k', 2): (4, 'new'), ('k', 3): (2, 'c')})
+        self.assertIs(merged, replacements)
+        self.assertEqual(merged, {('k', 1): (5, 'a'), ('k', 2): (4, 'new'), ('k', 3): (2, 'c')})
+
+
+class PendingWritesTest(unittest.TestCase):
+    def setUp(self):
+        self.replace_member = fragment.replace_member
+        fragment.replace_member = fake_replace
+        self.store = FakeStore(max_pending=100)
+
+    def tearDown(self):
+        fragment.replace_member = self.replace_member
+
+    def test_last_write_wins(self):
+        self.store.update_set('k', 0, 'a')
+        self.store.update_set('k', 0, 'b')
+        self.store.update_set('k', 86400, 'c')
+        self.store.flush()
+        self.assertEqual(sorted(self.store.fake.written), [('replace', 'k', 0, 'b'), ('replace', 'k', 86400, 'c')])
+
+    def test_last_write_wins_across_threads(self):
+        for first, last in [('a', 'b'), ('c', 'd')]:
+            self.store.update_set('k', 0, first)
+            thread = Thread(target=self.store.update_set, args=('k', 0, last))
+            thread.start()
+            thread.join()
+            self.store.flush()
+        self.assertEqual(self.store.fake.written, [('replace', 'k', 0, 'b'), ('replace', 'k', 0, 'd')])
+
+    def test_enqueue_order(self):
+        # Replacements are written where their last write was enqueued among the raw commands
+        self.store.execute('delete', 'k')
+        self.store.update_set('k', 0, 'a')
+        self.store.execute('hset', 'h', 'f', 1)
+        self.store.update_set('k', 0, 'b')
+        self.store.execute('delete', 'x')
+        self.store.flush()
+        self.assertEqual(self.store.fake.written, [('delete', 'k'), ('hset', 'h', 'f', 1), ('replace', 'k', 0, 'b'),
+                                                   ('delete', 'x')])
+
+    def test_flush_when_full(self):
+        self.store.max_pending = 2
+        self.store.update_set('k', 0, 'a')
+        self.assertEqual(self.store.fake.written, [])
+        self.store.update_set('k', 86400, 'b')
+        self.assertEqual(len(self.store.fake.written), 2)
+
+    def test_failed_writes_are_kept(self):
+        self.store.fake.failures = 1
+        self.store.execute('delete', 'k')
+        self.store.update_set('k', 0, 'a')
+        self.assertRaises(IOError, self.store.flush)
+        self.assertEqual(self.store.fake.written, [])
+        # A newer write of the same member replaces the failed one
+        self.store.update_set('k', 0, 'b')
+        self.store.flush()
+        self.assertEqual(self.store.fake.written, [('delete', 'k'), ('replace', 'k', 0, 'b')])
+
+    def test_asynchronous(self):
+        store = FakeStore(max_pending=100, asynchronous=True, max_latency=0.01, retry_delay=0.01)
+        store.fake.failures = 1
+        store.update_set('k', 0, 'a')
+        store.execute('delete', 'x')
+        # Waits until the failed batch is retried
+        store.flush()
+        self.assertEqual(store.fake.written, [('replace', 'k', 0, 'a'), ('delete', 'x')])
+        store.close()
+
+    def test_close_raises_lost_writes(self):
+        store = FakeStore(max_pending=100, asynchronous=True, max_latency=0.01, retry_delay=0.01)
+        store.fake.failures = 10 ** 6
+        store.update_set('k', 0, 'a')
+        self.assertRaises(IOError, store.close)
+        self.assertEqual(store.fake.written, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
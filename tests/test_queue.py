@@ -0,0 +1,83 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+__author__ = 'Fernando Serena'
+
+
+import time
+import unittest
+from datetime import date, datetime
+
+from sdh.metrics.jobs.queue import LocalCalculusQueue
+
+
+class LocalCalculusQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = LocalCalculusQueue()
+        self.queue.push_many([(date(2015, 1, 1), ['a']), (datetime(2015, 1, 3, 10), ['a', 'b']),
+                              (date(2015, 1, 2), [])])
+
+    def test_claim_most_recent(self):
+        self.assertEqual(len(self.queue), 2)
+        units = self.queue.claim(1)
+        self.assertEqual([(day, names) for day, names, _ in units], [(date(2015, 1, 3), ['a', 'b'])])
+        self.assertEqual((len(self.queue), self.queue.leased), (1, 1))
+        # Nothing else is claimable, and a leased day is not claimed twice
+        self.assertEqual([day for day, _, _ in self.queue.claim(5)], [date(2015, 1, 1)])
+        self.assertEqual(self.queue.claim(5), [])
+
+    def test_lease_expiry(self):
+        (day, names, token), = self.queue.claim(1, lease=0.05)
+        self.assertEqual(self.queue.claim(1, lease=0.05)[0][0], date(2015, 1, 1))
+        time.sleep(0.1)
+        # Expired leases go back to the queue, and their days are claimed again
+        (again, again_names, again_token), = self.queue.claim(1)
+        self.assertEqual((again, again_names), (day, names))
+        self.assertNotEqual(again_token, token)
+        # The lost lease can neither ack, renew nor release the day
+        self.assertFalse(self.queue.ack(day, token))
+        self.assertFalse(self.queue.renew(day, token))
+        self.assertFalse(self.queue.release(day, token))
+        self.assertTrue(self.queue.ack(again, again_token))
+        self.assertEqual(self.queue.leased, 0)
+
+    def test_renew(self):
+        (day, _, token), = self.queue.claim(1, lease=0.05)
+        time.sleep(0.03)
+        self.assertTrue(self.queue.renew(day, token, lease=1))
+        time.sleep(0.05)
+        self.assertEqual([d for d, _, _ in self.queue.claim(5)], [date(2015, 1, 1)])
+        self.assertTrue(self.queue.ack(day, token))
+
+    def test_push_while_leased(self):
+        (day, _, token), = self.queue.claim(1)
+        self.queue.push(day, ['c'])
+        # The day is pending again, but it is not claimed until its lease ends
+        self.assertEqual([d for d, _, _ in self.queue.claim(5)], [date(2015, 1, 1)])
+        self.assertTrue(self.queue.release(day, token))
+        self.assertEqual([(d, names) for d, names, _ in self.queue.claim(5)], [(day, ['a', 'b', 'c'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+__author__ = 'Fernando Serena'
+
+
+import calendar
+import os
+import random
+import unittest
+from datetime import datetime
+
+from sdh.metrics.store import aggregate, aggregate_many, store_calc, avg, percentile
+from sdh.metrics.store.fragment import FragmentStore
+from sdh.metrics.store.sharded import ShardedFragmentStore, parse_node, rebalance
+
+# host[:port] of a redis-server whose databases 13 to 15 can be flushed
+REDIS = os.environ.get('SDH_METRICS_TEST_REDIS')
+
+DAY = 86400
+FIRST_DAY = calendar.timegm(datetime(2015, 1, 1).timetuple())
+RANGES = [(None, None, 1), (None, None, 0), (FIRST_DAY, FIRST_DAY + 364 * DAY, 52),
+          (FIRST_DAY + 10 * DAY, FIRST_DAY + 100 * DAY, 7), (FIRST_DAY - 30 * DAY, FIRST_DAY + 30 * DAY, 3)]
+
+
+def new_store(db, **kwargs):
+    host, port, db = parse_node('{}/{}'.format(REDIS, db))
+    store = FragmentStore(host, port=port, db=db, **kwargs)
+    store.db.flushdb()
+    return store
+
+
+def populate(store, keys, seed=3):
+    rnd = random.Random(seed)
+    for key in keys:
+        for d in xrange(400):
+            if rnd.random() < 0.5:
+                store_calc(store, key, FIRST_DAY + d * DAY, rnd.choice([rnd.randint(-10, 100), rnd.random() * 50]))
+    store.flush()
+
+
+@unittest.skipUnless(REDIS, 'SDH_METRICS_TEST_REDIS is not set')
+class LuaAggregationTest(unittest.TestCase):
+    def setUp(self):
+        self.store = new_store(15)
+        populate(self.store, ['k'])
+
+    def tearDown(self):
+        self.store.db.flushdb()
+        self.store.close()
+
+    def test_same_as_client(self):
+        for aggr in [sum, avg, max, min]:
+            for fill in [0, 2.5]:
+                for begin, end, max_n in RANGES:
+                    client = aggregate(self.store, 'k', begin, end, max_n, aggr=aggr, fill=fill, engine='client')
+                    lua = aggregate(self.store, 'k', begin, end, max_n, aggr=aggr, fill=fill, engine='lua')
+                    self.assertEqual(lua[0], client[0])
+                    self.assertEqual(len(lua[1]), len(client[1]))
+                    for value, expected in zip(lua[1], client[1]):
+                        self.assertAlmostEqual(value, expected)
+
+    def test_custom_aggregation(self):
+        # Callables other than the built-in reducers are always reduced by the client
+        p90 = percentile(90)
+        for begin, end, max_n in RANGES:
+            self.assertEqual(aggregate(self.store, 'k', begin, end, max_n, aggr=p90, engine='lua'),
+                             aggregate(self.store, 'k', begin, end, max_n, aggr=p90, engine='client'))
+
+
+@unittest.skipUnless(REDIS, 'SDH_METRICS_TEST_REDIS is not set')
+class ShardedStoreTest(unittest.TestCase):
+    keys = ['k{}'.format(i) for i in range(12)]
+
+    def setUp(self):
+        self.single = new_store(15)
+        for db in (13, 14):
+            new_store(db).close()
+        self.nodes = ['{}/{}'.format(REDIS, db) for db in (13, 14)]
+        self.store = ShardedFragmentStore(self.nodes)
+
+    def tearDown(self):
+        for db in self.store.shards + [self.single.db]:
+            db.flushdb()
+        self.store.close()
+        self.single.close()
+
+    def test_keys_live_in_their_shard(self):
+        populate(self.store, self.keys)
+        shards = self.store.shards
+        self.assertTrue(all(len(db.keys('k*')) for db in shards))
+        for key in self.keys:
+            self.assertEqual([db.exists(key) for db in shards], [db is self.store.db_for(key) for db in shards])
+
+    def test_same_as_single_node(self):
+        populate(self.store, self.keys)
+        populate(self.single, self.keys)
+        for begin, end, max_n in RANGES:
+            self.assertEqual(aggregate_many(self.store, self.keys, begin, end, max_n),
+                             aggregate_many(self.single, self.keys, begin, end, max_n))
+            for key in self.keys[:3]:
+                self.assertEqual(aggregate(self.store, key, begin, end, max_n),
+                                 aggregate(self.single, key, begin, end, max_n))
+
+    def test_no_single_db(self):
+        self.assertRaises(TypeError, getattr, self.store, 'db')
+
+    def test_rebalance(self):
+        one = ShardedFragmentStore(self.nodes[:1])
+        populate(one, self.keys)
+        expected = aggregate_many(one, self.keys, None, None, 10)
+        one.close()
+        self.assertTrue(rebalance(self.store))
+        self.assertEqual(rebalance(self.store), 0)
+        self.assertEqual(aggregate_many(self.store, self.keys, None, None, 10), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
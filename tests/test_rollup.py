@@ -0,0 +1,151 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  This file is part of the Smart Developer Hub Project:
+    http://www.smartdeveloperhub.org
+
+  Center for Open Middleware
+        http://www.centeropenmiddleware.com/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2015 Center for Open Middleware.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+__author__ = 'Fernando Serena'
+
+
+import calendar
+import random
+import unittest
+from datetime import datetime
+
+from sdh.metrics.store import rollup
+from sdh.metrics.store.codec import encode
+from sdh.metrics.store.rollup import aggregate_steps, bucket_start, bucket_end, update_rollups, shortest_bucket, \
+    TIERS, DAY
+
+decompose = getattr(rollup, '__decompose')
+reduce_partials = getattr(rollup, '__reduce')
+partial = getattr(rollup, '__partial')
+
+FIRST_DAY = calendar.timegm(datetime(2015, 1, 1).timetuple())
+REDUCERS = {'sum': sum, 'min': min, 'max': max, 'avg': lambda x: sum(x) / float(len(x))}
+
+
+class FakePipeline(object):
+    def __init__(self, db):
+        self.db = db
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args))
+
+    def execute(self):
+        return [getattr(self.db, name)(*args) for name, args in self.commands]
+
+
+class FakeDb(object):
+    """The sorted set commands the rollups use, in memory"""
+
+    def __init__(self):
+        self.sets = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def zadd(self, key, score, member):
+        self.sets.setdefault(key, {})[member] = score
+
+    def zremrangebyscore(self, key, lo, hi):
+        members = self.sets.get(key, {})
+        for member, score in members.items():
+            if lo <= score <= hi:
+                del members[member]
+
+    def zrangebyscore(self, key, lo, hi):
+        members = self.sets.get(key, {})
+        return sorted([(member, score) for member, score in members.items() if lo <= score <= hi],
+                      key=lambda member: member[1])
+
+    def hincrby(self, key, field, amount):
+        pass
+
+
+def client_steps(series, steps, reducer, fill):
+    """Reduce every day of the steps, the way the client path does"""
+    return [REDUCERS[reducer]([series.get(day, fill) for day in range(s_begin, s_end, DAY)])
+            for s_begin, s_end in steps]
+
+
+class RollupTest(unittest.TestCase):
+    def setUp(self):
+        rnd = random.Random(7)
+        self.series = dict((FIRST_DAY + d * DAY, rnd.randint(-20, 100)) for d in range(800) if rnd.random() < 0.6)
+        self.db = FakeDb()
+        for ts, value in self.series.items():
+            self.db.zadd('k', ts, encode(ts, value))
+        buckets = set((key, tier, start) for ts in self.series
+                      for key, tier, start in rollup.dirty_buckets(TIERS, 'k', ts))
+        update_rollups(self.db, buckets)
+
+    def test_decompose(self):
+        for begin, days in [(FIRST_DAY, 365), (FIRST_DAY + 3 * DAY, 100), (FIRST_DAY + 40 * DAY, 6), (FIRST_DAY, 1)]:
+            end = begin + days * DAY
+            parts = decompose(TIERS[::-1], begin, end)
+            # Contiguous parts that cover the whole interval
+            self.assertEqual(parts[0][1], begin)
+            self.assertEqual(parts[-1][2], end)
+            self.assertEqual([p_end for _, _, p_end in parts[:-1]], [p_begin for _, p_begin, _ in parts[1:]])
+            for tier, p_begin, p_end in parts:
+                if tier is not None:
+                    self.assertEqual((bucket_start(tier, p_begin), bucket_end(tier, p_begin)), (p_begin, p_end))
+        self.assertEqual(decompose(TIERS[::-1], FIRST_DAY, FIRST_DAY + 365 * DAY),
+                         [('year', FIRST_DAY, FIRST_DAY + 365 * DAY)])
+
+    def test_reduce(self):
+        for reducer in REDUCERS:
+            for fill in [0, 5]:
+                for begin, days in [(FIRST_DAY, 365), (FIRST_DAY + 10 * DAY, 60), (FIRST_DAY + 700 * DAY, 200)]:
+                    end = begin + days * DAY
+                    partials = []
+                    for tier, p_begin, p_end in decompose(TIERS[::-1], begin, end):
+                        days_in = [ts for ts in range(p_begin, p_end, DAY) if ts in self.series]
+                        p = partial(days_in, [self.series[ts] for ts in days_in])
+                        if p is not None:
+                            partials.append(p)
+                    expected = client_steps(self.series, [(begin, end)], reducer, fill)[0]
+                    self.assertAlmostEqual(reduce_partials(reducer, partials, days, fill), expected)
+
+    def test_aggregate_steps(self):
+        for reducer in REDUCERS:
+            # 2015-01-05 is a Monday
+            for first, days_per_step, n_steps in [(4, 7, 20), (0, 28, 13), (3, 30, 24), (0, 365, 2), (10, 91, 8)]:
+                begin = FIRST_DAY + first * DAY
+                steps = [(begin + i * days_per_step * DAY, begin + (i + 1) * days_per_step * DAY)
+                         for i in range(n_steps)]
+                values = aggregate_steps(self.db, TIERS, 'k', steps, reducer, 0)
+                expected = client_steps(self.series, steps, reducer, 0)
+                self.assertEqual(len(values), len(expected))
+                for value, expected_value in zip(values, expected):
+                    self.assertAlmostEqual(value, expected_value)
+
+    def test_no_whole_bucket(self):
+        # Steps shorter than any bucket are left to the other paths
+        self.assertEqual(shortest_bucket(TIERS), 7 * DAY)
+        steps = [(FIRST_DAY + i * DAY, FIRST_DAY + (i + 1) * DAY) for i in range(30)]
+        self.assertIsNone(aggregate_steps(self.db, TIERS, 'k', steps, 'sum', 0))
+
+
+if __name__ == '__main__':
+    unittest.main()